@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""bots runs many trading bots in one process. It doesn't use Qt, and evaluates all bots of a
+strategy at once on every tick."""
+
+import arguments
+import sys
+import time
+
+import numpy as np
+import zmq
+
+from stexcore import CallbackChannel, Creds, FeedSocket
+
+
+class Strategy:
+    """Strategy decides for a batch of n bots at once. Every bot has its own parameters,
+    stored as arrays of length n."""
+    name = ''
+
+    def __init__(self, n, rng):
+        self.n = n
+        self.rng = rng
+
+    def decide(self, history, age, prices, positions, cash):
+        """Returns an (n, S) integer array of order quantities (positive to buy, negative to sell).
+
+        history is a (T, S) array of the last T prices, oldest first, and age the (S,) number of
+        ticks each symbol has been listed, so only the last age rows of its column are filled.
+        prices are the current prices (0 for delisted symbols), positions the (n, S) holdings
+        and cash the (n,) cash of the bots."""
+        raise NotImplementedError()
+
+    def budget(self, want, prices, cash, fraction):
+        """Splits fraction of every bot's cash over the symbols it wants to buy, and returns the
+        number of pieces that buys."""
+        per_bot = (cash * fraction) / np.maximum(want.sum(axis=1), 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            qty = np.floor(per_bot[:, None] / prices[None, :])
+        return np.where(want & (prices > 0), np.nan_to_num(qty, posinf=0), 0).astype(np.int64)
+
+
+class Momentum(Strategy):
+    """Buys stocks trading above their moving average, and sells them when they fall below it."""
+    name = 'momentum'
+
+    def __init__(self, n, rng):
+        super().__init__(n, rng)
+        self.lookback = rng.integers(5, 40, n)
+        self.threshold = rng.uniform(0.005, 0.03, n)
+        self.fraction = rng.uniform(0.05, 0.3, n)
+
+    def signal(self, history, age, prices):
+        """Returns the relative distance of prices from each bot's moving average, and whether
+        there was enough history to compute it."""
+        # Moving averages over each bot's lookback, from sums over the newest rows.
+        sums = np.cumsum(history[::-1], axis=0)
+        lookback = np.minimum(self.lookback, len(history))
+        sma = sums[lookback - 1] / lookback[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            signal = np.nan_to_num(prices[None, :] / sma - 1)
+        return signal, (lookback[:, None] <= age[None, :]) & (prices > 0)[None, :]
+
+    def decide(self, history, age, prices, positions, cash):
+        signal, valid = self.signal(history, age, prices)
+        buy = valid & (signal > self.threshold[:, None]) & (positions == 0)
+        sell = valid & (signal < -self.threshold[:, None]) & (positions > 0)
+        return self.budget(buy, prices, cash, self.fraction) - np.where(sell, positions, 0)
+
+
+class MeanReversion(Momentum):
+    """Buys stocks trading below their moving average, and sells them once they are above it."""
+    name = 'meanrev'
+
+    def decide(self, history, age, prices, positions, cash):
+        signal, valid = self.signal(history, age, prices)
+        buy = valid & (signal < -self.threshold[:, None]) & (positions == 0)
+        sell = valid & (signal > self.threshold[:, None]) & (positions > 0)
+        return self.budget(buy, prices, cash, self.fraction) - np.where(sell, positions, 0)
+
+
+class RandomTrader(Strategy):
+    """Buys and sells small amounts at random."""
+    name = 'random'
+
+    def __init__(self, n, rng):
+        super().__init__(n, rng)
+        self.probability = rng.uniform(0.001, 0.02, n)
+
+    def decide(self, history, age, prices, positions, cash):
+        trade = (self.rng.random((self.n, len(prices))) < self.probability[:, None]) & (prices > 0)[None, :]
+        buy = trade & (self.rng.random(trade.shape) < 0.5)
+        sell = trade & ~buy & (positions > 0)
+        return self.budget(buy, prices, cash, 0.05) - np.where(sell, np.maximum(positions // 2, 1), 0)
+
+
+STRATEGIES = {s.name: s for s in [Momentum, MeanReversion, RandomTrader]}
+
+
+class BotRuntime:
+    """BotRuntime runs a population of bots over one feed subscription and one callback channel.
+
+    The bots' cash and holdings are kept as arrays (bots x symbols), updated from execution
+    results, and every strategy decides for all of its bots in one call per tick."""
+
+    # Number of past ticks kept for the strategies.
+    HISTORY = 64
+    # Number of ticks after which the server has expired any order (see server/engine.py).
+    ORDER_TTL = 600
+
+    def __init__(self, zctx, creds, strategies, bots_per_strategy, prefix='bot', seed=None, hwm=None):
+        rng = np.random.default_rng(seed)
+        self.bots = []
+        # (strategy, first bot, last bot + 1)
+        self.strategies = []
+        for cls in strategies:
+            start = len(self.bots)
+            for i in range(bots_per_strategy):
+                self.bots.append(Creds(user='{}-{}-{}'.format(prefix, cls.name, i), password=creds.password,
+                                       addr=creds.addr, group=creds.group, market=creds.market))
+            self.strategies.append((cls(bots_per_strategy, rng), start, len(self.bots)))
+
+        n = len(self.bots)
+        self.cash = np.zeros(n)
+        self.ready = np.zeros(n, dtype=bool)
+        self.symbols = {}
+        self.names = []
+        self.positions = np.zeros((n, 0), dtype=np.int64)
+        # Whether a bot has an order for a symbol that hasn't been executed yet.
+        self.outstanding = np.zeros((n, 0), dtype=bool)
+        self.prices = np.zeros(0)
+        self.history = np.zeros((self.HISTORY, 0))
+        self.age = np.zeros(0, dtype=np.int64)
+        self.ticks = 0
+        # Request ID -> bot for logins, and -> (bot, column) for orders.
+        self.logins = {}
+        self.orders = {}
+        # Request ID -> tick, for orders the channel gave up on but the server may still execute.
+        self.abandoned = {}
+
+        self.feed = FeedSocket(zctx, creds, hwm=hwm)
+        self.feed.newData.connect(self.on_tick)
+        self.channel = CallbackChannel(zctx, creds, max_inflight=256, max_queue=100000)
+        self.channel.response.connect(self.on_response)
+        self.channel.orderExecuted.connect(self.on_execution)
+        self.channel.requestFailed.connect(self.on_failure)
+
+    def start(self):
+        for i, bot in enumerate(self.bots):
+            # The response may be handled while sending, so the ID is recorded first.
+            self.logins[self.channel.next_id] = i
+            self.channel.login(creds=bot)
+
+    def column(self, sym):
+        """Returns the column of sym, adding one if necessary."""
+        col = self.symbols.get(sym)
+        if col is None:
+            col = len(self.names)
+            self.symbols[sym] = col
+            self.names.append(sym)
+            self.positions = np.hstack([self.positions, np.zeros((len(self.bots), 1), dtype=np.int64)])
+            self.outstanding = np.hstack([self.outstanding, np.zeros((len(self.bots), 1), dtype=bool)])
+            self.prices = np.append(self.prices, 0)
+            self.history = np.hstack([self.history, np.zeros((self.HISTORY, 1))])
+            self.age = np.append(self.age, 0)
+        return col
+
+    def on_tick(self, data):
+        cols, prices, split = [], [], []
+        for sym, upd in data.items():
+            if sym.startswith('_'):
+                continue
+            cols.append(self.column(sym))
+            prices.append(upd['price'])
+            split.append(upd.get('split', False))
+        cols = np.array(cols, dtype=np.int64)
+
+        # Columns of symbols that are gone keep price 0 and are never traded again. A listed
+        # symbol may trade at 0 as well, so only the symbols in the tick are listed.
+        self.prices = np.zeros(len(self.names))
+        self.prices[cols] = prices
+        listed = np.zeros(len(self.names), dtype=bool)
+        listed[cols] = True
+        self.positions[:, ~listed] = 0
+        self.positions[:, cols[np.array(split, dtype=bool)]] *= 2
+        self.age = np.where(listed, self.age + 1, 0)
+
+        self.ticks += 1
+        for id in [id for id, tick in self.abandoned.items() if tick + self.ORDER_TTL < self.ticks]:
+            self.abandoned.pop(id)
+            self.orders.pop(id, None)
+        self.history[self.ticks % self.HISTORY] = self.prices
+        history = np.roll(self.history, -(self.ticks % self.HISTORY) - 1, axis=0)
+
+        for strategy, start, end in self.strategies:
+            orders = strategy.decide(history, self.age, self.prices, self.positions[start:end], self.cash[start:end])
+            orders[~self.ready[start:end]] = 0
+            orders[self.outstanding[start:end]] = 0
+            for b, col in zip(*np.nonzero(orders)):
+                bot = start + b
+                self.orders[self.channel.next_id] = (bot, col)
+                self.outstanding[bot, col] = True
+                self.channel.send_order({'symbol': self.names[col], 'qty': int(orders[b, col])},
+                                        creds=self.bots[bot])
+
+    def on_response(self, id, msg):
+        bot = self.logins.pop(id, None)
+        if bot is not None and 'account' in msg:
+            self.cash[bot] = msg['account'].get('cash', 0)
+            for sym, stock in msg['account'].get('stock', {}).items():
+                self.positions[bot, self.column(sym)] = stock.get('num', 0)
+            self.ready[bot] = True
+        elif msg.get('ok') is False and id in self.orders:
+            order = self.orders.pop(id)
+            if self.abandoned.pop(id, None) is None:
+                self.outstanding[order] = False
+
+    def on_execution(self, result):
+        order = self.orders.pop(result.get('id'), None)
+        if order is None:
+            return
+        bot, col = order
+        if self.abandoned.pop(result.get('id'), None) is None:
+            self.outstanding[bot, col] = False
+        self.positions[bot, col] = result.get('num', self.positions[bot, col] + (result.get('qty') or 0))
+        self.cash[bot] = result.get('cash', self.cash[bot])
+
+    def on_failure(self, id, msg, error):
+        """Frees the slot of an order the channel gave up on, so the bot may trade again. The
+        server may have accepted the order nonetheless, so its result is still applied if it
+        arrives before the order would have expired."""
+        self.logins.pop(id, None)
+        if id in self.orders:
+            self.outstanding[self.orders[id]] = False
+            self.abandoned[id] = self.ticks
+
+    def run(self):
+        p = zmq.Poller()
+        p.register(self.feed.sock, zmq.POLLIN)
+        p.register(self.channel.socket, zmq.POLLIN)
+        while True:
+            events = dict(p.poll(self.channel.TIMEOUT_MS // 4))
+            if self.channel.socket in events:
+                self.channel.receive()
+            if self.feed.sock in events:
+                self.feed.receive()
+            self.channel.check_timeouts()
+
+
+class Bots(arguments.BaseArguments):
+    _doc = """
+    Usage:
+        stex-bots [options]
+
+    Options:
+        -a --address=<address>      Address of the server as host:port or ZMQ endpoint, e.g.
+                                    ipc:///tmp/stex (default localhost:9988).
+        --bots=<bots>               Number of bots per strategy (default 10).
+        --strategies=<strategies>   Comma-separated strategies: momentum, meanrev, random (default all).
+        --group=<group>             Group the bots play in (default bots).
+        --market=<market>           Market to play in, if the server hosts several.
+        --prefix=<prefix>           Prefix of the bots' user names (default bot).
+        --hwm=<ticks>               Number of ticks queued for the bots before further ones are
+                                    dropped (default: ZMQ's, 1000).
+        --help                      Print help.
+    """
+
+    def __init__(self):
+        super(arguments.BaseArguments, self).__init__(doc=self._doc)
+        if self.help:
+            print(self._doc)
+            sys.exit(0)
+
+    def runtime(self, zctx):
+        names = self.strategies.split(',') if self.strategies else list(STRATEGIES)
+        for name in names:
+            if name not in STRATEGIES:
+                raise ValueError('unknown strategy: {}'.format(name))
+        creds = Creds(user=self.prefix or 'bot', addr=self.address or 'localhost:9988', group=self.group or 'bots',
+                      market=self.market or '')
+        return BotRuntime(zctx, creds, [STRATEGIES[n] for n in names], int(self.bots or 10),
+                          prefix=self.prefix or 'bot', hwm=int(self.hwm) if self.hwm else None)
+
+
+def main():
+    started = time.monotonic()
+    runtime = Bots().runtime(zmq.Context())
+    runtime.start()
+    print('{} bots started in {:.0f} ms'.format(len(runtime.bots), (time.monotonic() - started) * 1000),
+          file=sys.stderr)
+    runtime.run()
+
+
+if __name__ == '__main__':
+    main()
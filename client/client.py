@@ -1,25 +1,21 @@
 #!/usr/bin/env python3
 
 import arguments
-import json
 import os
 import os.path as path
 import sys
 import urllib.parse as url
 import zmq
 
+import numpy as np
+
+from stexcore import CallbackChannel, Creds, Depot, FeedSocket, TickCache
+
 import PyQt5.QtWidgets as wid
 import PyQt5.QtCore as core
 import PyQt5.QtChart as chart
 
 
-class Creds:
-    user = ''
-    password = ''
-    addr = ''
-    group = ''
-
-
 class ClientConfigDialog(wid.QDialog):
     addr = None
     user = None
@@ -123,106 +119,6 @@ class ClientConfigDialog(wid.QDialog):
         return creds
 
 
-class Depot(core.QObject):
-    """Depot contains several DepotStocks and manages buying/selling them."""
-    cash = 0
-    stock = {}
-
-    priceUpdated = core.pyqtSignal(str)
-    depotChanged = core.pyqtSignal()
-
-    def add_stock(self, stocksym, stock):
-        if stocksym not in self.stock:
-            self.stock[stocksym] = stock
-
-    def remove_stock(self, stocksym):
-        if stocksym in self.stock:
-            self.stock.pop(stocksym)
-
-    def buy(self, stocksym, num):
-        if stocksym not in self.stock:
-            raise AttributeError('stock not found!')
-        stock = self.stock[stocksym]
-        price = stock.current_price
-        if price == 0:
-            price = 1
-        if price * num > self.cash:
-            num = int(self.cash / price)
-        self.cash -= price * num
-        stock.change_hold(num)
-        self.depotChanged.emit()
-        return True
-
-    def sell(self, stocksym, num):
-        if stocksym not in self.stock:
-            raise AttributeError('stock not found!')
-        stock = self.stock[stocksym]
-        price = stock.current_price
-        if num > stock.current_num:
-            num = stock.current_num
-        self.cash += price * num
-        stock.change_hold(-num)
-        self.depotChanged.emit()
-        return True
-
-    def update(self, message):
-        for sym, upd in message.items():
-            if sym.startswith('_'):
-                continue
-            if sym in self.stock:
-                self.stock[sym].update(upd)
-                self.priceUpdated.emit(sym)
-                self.depotChanged.emit()
-
-    def total_value(self):
-        value = 0
-        for sym, stock in self.stock.items():
-            value += stock.current_num * stock.current_price
-        return value
-
-    def to_dict(self):
-        s = {'cash': self.cash, 'value': self.cash + self.total_value(), 'stock': {}, '_stockdepot': True}
-        for sym, stock in self.stock.items():
-            stock_sum = {'num': stock.current_num}
-            s['stock'][sym] = stock_sum
-        return s
-
-
-class DepotStock:
-    """DepotStock is a position of stock in a single company in the depot. It
-    manages its own price and volume as well as some statistics."""
-    sym = ''
-
-    current_price = -1
-    total_buy_price = 0
-    current_num = 0
-
-    def __init__(self, sym):
-        self.sym = sym
-
-    def update(self, upd):
-        """Apply an update received from the stex server.
-
-        upd is a stock update message.
-        """
-        self.current_price = upd['price']
-        if 'qty' in upd:
-            self.current_num = upd['qty']
-        if upd['split']:
-            self.current_num = self.current_num * 2
-
-    def change_hold(self, diff):
-        assert -diff <= self.current_num
-        if diff > 0:
-            self.total_buy_price += diff * self.current_price
-        if diff < 0:
-            self.total_buy_price += diff * self.avg_buy_price()
-        self.current_num += diff
-
-    def avg_buy_price(self):
-        return self.total_buy_price / (self.current_num or 1)
-
-
 class StockGraph(chart.QChartView):
     """StockGraph is a stock price graph in the UI. Its knowledge of the stock is exclusively
     updated by other objects like StockWidget."""
@@ -285,6 +181,13 @@ class StockGraph(chart.QChartView):
 
         self.plot()
 
+    def set_history(self, values):
+        """Replaces the plotted prices by values, oldest first."""
+        values = values[-self.MAX_LEN:]
+        self.series.replace([core.QPointF(x, values[x] if x < len(values) else 0) for x in self.XAXIS])
+        self.current = len(values) % self.MAX_LEN
+        self.update_stock(None)
+
     def plot(self):
         """Updates the graph widget."""
         while super().chart().series():
@@ -342,18 +245,22 @@ class StockWidget(wid.QWidget):
         return hbox
 
     def on_buy(self):
-        if not self.depot.buy(self.sym, self.quantity_spinner.value()):
+        if not self.depot.place_order(self.sym, self.quantity_spinner.value()):
             print("Warning: couldn't buy {}".format(self.depotstock.sym))
-        self.update_values()
-        self.graph.update_stock(None)
 
     def on_sell(self):
-        if not self.depot.sell(self.sym, self.quantity_spinner.value()):
+        if not self.depot.place_order(self.sym, -self.quantity_spinner.value()):
             print("Warning: couldn't sell {}".format(self.depotstock.sym))
+
+    # Triggered by the client when an order for this stock was executed.
+    @core.pyqtSlot(str)
+    def on_position_changed(self, sym):
+        if sym != self.sym:
+            return
         self.update_values()
         self.graph.update_stock(None)
 
-    # Triggered by the depot when there is new data for any stock (so we filter if the update is for us)
+    # Triggered by the client when there is new data for this stock.
     @core.pyqtSlot(str)
     def update(self, sym):
         if sym != self.sym:
@@ -395,118 +302,52 @@ class DepotWidget(wid.QWidget):
 
 
 class ClientSocket(core.QObject):
-    zctx = None
-    sock = None
+    """ClientSocket delivers the stock data feed of a FeedSocket to the Qt event loop."""
+    feed = None
     socknot = None
 
     on_new_message = core.pyqtSignal(dict)
 
-    def __init__(self, zctx, creds):
-        """callback is a function taking received data dicts."""
+    def __init__(self, zctx, creds, hwm=None):
         super().__init__()
-
-        self.zctx = zctx
-        self.sock = self.zctx.socket(zmq.SUB)
-        self.sock.setsockopt(zmq.IPV6, 1)
-        self.sock.subscribe('')
-        self.sock.setsockopt(zmq.RCVTIMEO, 0)
-
-        self.sock.connect('tcp://{}'.format(creds.addr))
-        fd = self.sock.getsockopt(zmq.FD)
-        self.socknot = core.QSocketNotifier(fd, core.QSocketNotifier.Read)
+        self.feed = FeedSocket(zctx, creds, hwm=hwm)
+        self.feed.newData.connect(self.on_new_message.emit)
+        self.socknot = core.QSocketNotifier(self.feed.fileno(), core.QSocketNotifier.Read)
         self.socknot.activated.connect(self.on_activated)
 
     @core.pyqtSlot(int)
     def on_activated(self, _sock):
-        try:
-            while True:
-                msg = self.sock.recv_json()
-                if '_stockdata' not in msg:
-                    return
-                self.on_new_message.emit(msg)
-        except Exception as e:
-            return
+        self.feed.receive()
 
 
 class CallbackSocket(core.QObject):
-    """CallbackSocket sends messages to the stex server and receives responses."""
-    creds = None
-    socket = None
-    waiting = False
-    queue = []
-
-    newGroupInfo = core.pyqtSignal(dict)
+    """CallbackSocket drives a CallbackChannel from the Qt event loop. The channel's signals
+    and methods are available directly on the CallbackSocket."""
+    channel = None
 
     def __init__(self, zctx, creds):
         super().__init__()
-        self.creds = creds
-        socket = zctx.socket(zmq.REQ)
-        socket.setsockopt(zmq.IPV6, 1)
-        socket.setsockopt(zmq.RCVTIMEO, 0)
-        socket.setsockopt(zmq.SNDTIMEO, 10)
-        
-        (host, _, port) = creds.addr.partition(':')
-        socket.connect('tcp://{}:{}'.format(host, int(port if port else '9988') + 1))
-        self.socket = socket
-
-        fd = self.socket.getsockopt(zmq.FD)
-        self.socknot = core.QSocketNotifier(fd, core.QSocketNotifier.Read)
+        self.channel = CallbackChannel(zctx, creds)
+        self.socknot = core.QSocketNotifier(self.channel.fileno(), core.QSocketNotifier.Read)
         self.socknot.activated.connect(self.on_reply)
 
-    def login(self):
-        self.try_send({'_stocklogin': True})
-
-    def send_depot(self, depot):
-        summary = depot.to_dict()
-        # Don't attempt to send if something's already waiting.
-        self.try_send(summary, permanent=False)
-
-    def send_order(self, order):
-        """order should contain the keys 'symbol', 'qty'."""
-        order['type'] = 'order'
-        self.try_send(order, permanent=True)
-
-    def wrap(self, msg, type):
-        return json.dumps({
-            '_stockcallback': True,
-            'user': self.creds.user,
-            'password': self.creds.password,
-            'group': self.creds.group,
-            'type': type,
-            'msg': msg,
-        })
-
-    def try_send(self, msg, permanent=True):
-        msg = self.wrap(msg, msg.get('type', 'callback'))
-        if self.waiting and permanent:
-            self.queue.append(msg)
-        else:
-            try:
-                self.socket.send_string(msg)
-                self.waiting = True
-                return True
-            except Exception as e:
-                print ('DEBUG: Send failed on REQ socket: ', e)
-                if permanent:
-                    self.queue.append(msg)
-        assert len(self.queue) < 5
-        return False
+        self.retry_timer = core.QTimer(self)
+        self.retry_timer.setInterval(self.channel.TIMEOUT_MS // 4)
+        self.retry_timer.timeout.connect(self.on_timer)
+        self.retry_timer.start()
+
+    def __getattr__(self, name):
+        return getattr(self.channel, name)
 
     @core.pyqtSlot(int)
     def on_reply(self, _sock):
-        try:
-            msg = self.socket.recv_json()
-            print('DEBUG: Received response: {}'.format(msg))
-            self.waiting = False
+        self.channel.receive()
 
-            if '_stockresp' in msg and 'groupinfo' in msg:
-                self.newGroupInfo.emit(msg['groupinfo'])
-
-            # Try sending oldest message.
-            if len(self.queue) > 0:
-                self.try_send(self.queue.pop(0))
-        except Exception as e:
-            print ('DEBUG: RECV failed on REQ socket: ', e)
+    @core.pyqtSlot()
+    def on_timer(self):
+        # Also drains the socket, in case a send consumed the FD's edge unnoticed.
+        self.channel.check_timeouts()
+        self.channel.receive()
 
 
 class Client(arguments.BaseArguments, wid.QWidget):
@@ -515,8 +356,12 @@ class Client(arguments.BaseArguments, wid.QWidget):
         stex [options]
 
     Options
-        --defaults      Use cached defaults if available.
-        --help          Show help.
+        --defaults          Use cached defaults if available.
+        --market=<market>   Market to play in, if the server hosts several.
+        --no-cache          Don't keep recent ticks and the depot on disk.
+        --hwm=<ticks>       Number of ticks queued for this client before further ones are
+                            dropped (default: ZMQ's, 1000).
+        --help              Show help.
     """
 
     creds = Creds()
@@ -525,6 +370,12 @@ class Client(arguments.BaseArguments, wid.QWidget):
     zctx = zmq.Context()
     timer = None
     callback_sock = None
+    cache = None
+    cache_dir = '.cache/stex/'
+    # Depot version last saved to the cache.
+    cached_version = None
+    # Whether the stock widgets were matched with the live data yet.
+    reconciled = False
 
     def __init__(self):
         super(wid.QWidget, self).__init__()
@@ -550,6 +401,7 @@ class Client(arguments.BaseArguments, wid.QWidget):
 
     def set_creds(self, creds):
         self.creds = creds
+        self.creds.market = self.market or ''
 
     mainhbox = None
     stocksvbox = None
@@ -578,7 +430,10 @@ class Client(arguments.BaseArguments, wid.QWidget):
 
         self.stocksvbox = wid.QVBoxLayout(self)
         self.waiting = wid.QLabel("Waiting for incoming stock data - hang tight!", self)
+        self.failed = wid.QLabel('', self)
+        self.failed.hide()
         self.stocksvbox.addWidget(self.depot_widget)
+        self.stocksvbox.addWidget(self.failed)
         self.stocksvbox.addWidget(self.waiting)
         self.show()
 
@@ -590,11 +445,82 @@ class Client(arguments.BaseArguments, wid.QWidget):
         self.mainhbox.addLayout(self.stocksvbox)
         self.mainhbox.addWidget(self.group_table)
 
-        self.sock = ClientSocket(self.zctx, self.creds)
+        self.sock = ClientSocket(self.zctx, self.creds, hwm=int(self.hwm) if self.hwm else None)
         self.sock.on_new_message.connect(self.on_new_data)
         self.callback_sock = CallbackSocket(self.zctx, self.creds)
-        self.callback_sock.login()
         self.callback_sock.newGroupInfo.connect(self.on_new_group_info)
+        self.callback_sock.accountInfo.connect(self.depot.load_account)
+        self.callback_sock.orderExecuted.connect(self.depot.apply_execution)
+        self.callback_sock.orderExecuted.connect(self.on_order_executed)
+        self.callback_sock.depotAcknowledged.connect(self.depot.acknowledge)
+        self.callback_sock.feedSlow.connect(self.sock.feed.set_conflate)
+        self.callback_sock.requestFailed.connect(self.on_request_failed)
+        self.depot.orderRequested.connect(self.on_order_requested)
+        self.depot.priceUpdated.connect(self.on_price_updated)
+        self.depot.positionChanged.connect(self.on_position_changed)
+        self.callback_sock.historyReceived.connect(self.on_history)
+        self.open_cache()
+        self.callback_sock.login()
+
+    def open_cache(self):
+        """Opens the tick cache of this server, market and user, and shows what it holds."""
+        if self.no_cache:
+            return
+        home = os.environ.get('HOME') or path.join('/home/', os.environ.get('USER'))
+        name = url.quote('{}_{}_{}'.format(self.creds.addr, self.creds.market, self.creds.user), safe='')
+        try:
+            self.cache = TickCache(path.join(home, self.cache_dir, name), rows=StockGraph.MAX_LEN)
+        except OSError as e:
+            sys.stderr.write("Couldn't open tick cache: {}\n".format(e))
+            return
+        snapshot = self.cache.load_depot()
+        if snapshot:
+            self.depot.restore(snapshot)
+        self.show_history()
+
+    def show_history(self):
+        """Redraws the graphs of the listed stocks from the tick cache."""
+        _, prices = self.cache.history()
+        last = {}
+        for sym, p in sorted(prices.items()):
+            p = p[~np.isnan(p)]
+            if len(p) == 0:
+                continue
+            self.waiting.hide()
+            self.list_stock(sym)
+            last[sym] = {'price': float(p[-1]), 'split': False}
+        if not self.reconciled:
+            # Prices to value the depot with until live data arrive.
+            self.depot.update(last)
+        for sym, p in prices.items():
+            if sym in self.stock_widgets:
+                self.stock_widgets[sym].graph.set_history((p[~np.isnan(p)] / 100).tolist())
+
+    @core.pyqtSlot(list)
+    def on_history(self, ticks):
+        """Fills the gap in the cache with the ticks sent by the server, and redraws the graphs."""
+        if self.cache is None:
+            return
+        for data in ticks:
+            self.cache.write(data)
+        self.show_history()
+
+    def cache_tick(self, stockdata, first):
+        """Writes a live tick to the cache, and asks the server for the ticks the cache is missing
+        when the client (re)connected or missed ticks."""
+        tick, newest = stockdata.get('_tick'), self.cache.newest
+        if (first or '_gap' in stockdata) and isinstance(tick, int) and tick <= newest:
+            # The server was restarted, or seeked in a replay; its ticks have nothing to do with
+            # the cached ones, nor with the graphs drawn from them.
+            self.cache.clear()
+            self.cache.write(stockdata)
+            for widget in self.stock_widgets.values():
+                widget.graph.set_history([])
+            self.show_history()
+            return
+        if (first or '_gap' in stockdata) and newest and isinstance(tick, int) and tick > newest + 1:
+            self.callback_sock.request_history(newest)
+        self.cache.write(stockdata)
 
     stock_widgets = {}
 
@@ -602,33 +528,64 @@ class Client(arguments.BaseArguments, wid.QWidget):
     def on_new_data(self, stockdata):
         """React to new stock data from the server."""
         self.waiting.hide()
+        first = not self.reconciled
+        if first or '_gap' in stockdata:
+            # Without the preceding ticks, the listing events are unknown; compare symbols.
+            self.reconcile(stockdata)
+        for event in stockdata.get('_events', ()):
+            if event['event'] == 'delisted':
+                self.delist_stock(event['symbol'], event['price'])
+            elif event['event'] == 'listed':
+                self.list_stock(event['symbol'])
         self.depot.update(stockdata)
-
-        # Hide widget and remove from depot
-        to_remove = []
-        for sym, wid in self.stock_widgets.items():
-            if sym not in stockdata:
-                print("{} bankrupt!".format(sym))
-                wid.hide()
-                for r in self.stockrows:
-                    r.removeWidget(wid)
-                to_remove.append(sym)
-        for s in to_remove:
-            self.stock_widgets.pop(s)
-            self.depot.remove_stock(s)
-
-        for sym, upd in sorted(stockdata.items()):
-            if sym != '_stockdata' and sym not in self.stock_widgets:
-                depotstock = DepotStock(sym)
-                sg = StockGraph(sym, None)
-                sw = StockWidget(sg, self.depot, depotstock)
-                sw.setObjectName(sym)
-                sw.setParent(self)
-                self.stock_widgets[sym] = sw
-                sw.show()
-                self.add_stock_widget(sw)
-                self.depot.add_stock(sym, depotstock)
-                self.depot.priceUpdated.connect(sw.update)
+        if self.cache is not None:
+            self.cache_tick(stockdata, first)
+
+    def reconcile(self, stockdata):
+        """Adds and removes stock widgets to match the symbols in stockdata."""
+        self.reconciled = True
+        for sym in [s for s in self.stock_widgets if s not in stockdata]:
+            self.delist_stock(sym)
+        for sym in sorted(stockdata):
+            if not sym.startswith('_') and sym not in self.stock_widgets:
+                self.list_stock(sym)
+
+    def list_stock(self, sym):
+        if sym in self.stock_widgets:
+            return
+        depotstock = self.depot.add_stock(sym)
+        sg = StockGraph(sym, None)
+        sw = StockWidget(sg, self.depot, depotstock)
+        sw.setObjectName(sym)
+        sw.setParent(self)
+        self.stock_widgets[sym] = sw
+        sw.show()
+        self.add_stock_widget(sw)
+
+    def delist_stock(self, sym, price=None):
+        """Hides the widget of sym and removes it from the depot."""
+        wid = self.stock_widgets.pop(sym, None)
+        if wid is None:
+            return
+        if price is None:
+            print("{} bankrupt!".format(sym))
+        else:
+            print("{} bankrupt at {:.2f}!".format(sym, price / 100))
+        wid.hide()
+        for r in self.stockrows:
+            r.removeWidget(wid)
+        self.depot.remove_stock(sym)
+
+    # The depot's signals carry the symbol; only its widget has to be told.
+    def on_price_updated(self, sym):
+        sw = self.stock_widgets.get(sym)
+        if sw is not None:
+            sw.update(sym)
+
+    def on_position_changed(self, sym):
+        sw = self.stock_widgets.get(sym)
+        if sw is not None:
+            sw.on_position_changed(sym)
 
     @core.pyqtSlot(dict)
     def on_new_group_info(self, groupinfo):
@@ -645,11 +602,43 @@ class Client(arguments.BaseArguments, wid.QWidget):
             self.group_table.setItem(i, 1, wid.QTableWidgetItem('{:.0f} ø'.format(value)))
             i += 1
 
+    def on_request_failed(self, _id, msg, error):
+        """Tells the user about an order or login the server didn't accept, or that couldn't
+        be delivered."""
+        if 'symbol' in msg:
+            text = 'Order to {} {} {} failed'.format('buy' if msg.get('qty', 0) > 0 else 'sell',
+                                                    abs(msg.get('qty', 0)), msg['symbol'])
+        elif '_stocklogin' in msg:
+            text = 'Login failed'
+        else:
+            return
+        text += ': {}.'.format(error) if error else ': no response from the server.'
+        self.failed.setText(text)
+        self.failed.show()
+
+    def on_order_executed(self, result):
+        if result.get('status') in ('rejected', 'expired'):
+            self.failed.setText('Order for {} {}.'.format(result.get('symbol'), result['status']))
+            self.failed.show()
+        elif result.get('qty'):
+            self.failed.hide()
+
+    @core.pyqtSlot(str, int)
+    def on_order_requested(self, sym, qty):
+        if not self.callback_sock:
+            return
+        self.callback_sock.send_order({'symbol': sym, 'qty': qty})
+
     @core.pyqtSlot()
     def on_periodic_timer(self):
         if not self.callback_sock:
             return
-        self.callback_sock.send_depot(self.depot)
+        self.callback_sock.send_depot(self.depot, feed=self.sock.feed)
+        if self.cache is not None:
+            if self.depot.version != self.cached_version:
+                self.cache.save_depot(self.depot.snapshot())
+                self.cached_version = self.depot.version
+            self.cache.flush()
 
 
 def main():
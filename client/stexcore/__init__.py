@@ -0,0 +1,9 @@
+"""stexcore is the Qt-free core of the stex client: feed subscription, depot accounting, the
+callback channel to the server and the local tick cache. The GUI client and the bot runtime are
+built on it."""
+
+from .cache import TickCache
+from .callback import CallbackChannel, PendingRequest
+from .depot import Depot, DepotStock
+from .feed import Creds, FeedSocket, endpoints
+from .signal import Signal
@@ -0,0 +1,211 @@
+"""A persistent cache of recent ticks and the depot, so a restarted client can show them at once.
+
+The tick cache is a memory-mapped file:
+
+    header: magic (8 bytes) | number of columns (u32) | number of rows (u32)
+    columns: one per symbol: symbol (16 bytes) | first tick of the symbol (u64) | CRC32 (u32) | unused (u32)
+    rows: a ring of ticks, tick t in row t % rows: tick (u64) | CRC32 (u32) | unused (u32) | price per column (f32)
+
+A row is invalidated (tick 0) before it is overwritten, and entries are only used if their CRC
+matches, so a client killed at any point -- or a machine losing some of the pages -- leaves a
+cache that is at worst missing the entries being written at the time.
+
+The depot is a small JSON file next to it, replaced atomically.
+"""
+
+import json
+import mmap
+import os
+import zlib
+
+import numpy as np
+
+MAGIC = b'STEXTIC1'
+_header = np.dtype([('magic', 'S8'), ('columns', '<u4'), ('rows', '<u4')])
+_column = np.dtype([('name', 'S16'), ('since', '<u8'), ('crc', '<u4'), ('unused', '<u4')])
+
+
+def _row(columns):
+    return np.dtype([('tick', '<u8'), ('crc', '<u4'), ('unused', '<u4'), ('prices', '<f4', (columns,))])
+
+
+class TickCache:
+    """TickCache keeps the last ticks of a server's market in a ring file of at most max_bytes.
+
+    Columns are assigned to symbols as they appear, and reused once a symbol is gone; a column
+    is only valid for ticks from the one in which its symbol got it."""
+
+    def __init__(self, path, columns=64, rows=500, max_bytes=16 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.want_rows = rows
+        self.file = None
+        if not self.open():
+            self.create(columns)
+
+    def size(self, columns, rows):
+        return _header.itemsize + columns * _column.itemsize + rows * _row(columns).itemsize
+
+    def open(self):
+        """Maps an existing cache file. Returns False if there is none, or it is unusable."""
+        try:
+            self.file = open(self.path, 'r+b')
+            header = np.frombuffer(self.file.read(_header.itemsize), _header)[0]
+            if header['magic'] != MAGIC or os.fstat(self.file.fileno()).st_size != self.size(
+                    int(header['columns']), int(header['rows'])):
+                raise ValueError('invalid tick cache')
+        except (OSError, ValueError, IndexError):
+            self.close()
+            return False
+        self.map(int(header['columns']), int(header['rows']))
+        self.load()
+        return True
+
+    def create(self, columns):
+        """(Re)creates an empty cache file with room for columns symbols."""
+        self.close()
+        row = _row(columns).itemsize
+        rows = max(min(self.want_rows, (self.max_bytes - self.size(columns, 0)) // row), 2)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.file = open(self.path, 'w+b')
+        self.file.truncate(self.size(columns, rows))
+        self.map(columns, rows)
+        # Written last, so a cache whose creation was interrupted is recreated next time.
+        self.header['columns'], self.header['rows'] = columns, rows
+        self.header['magic'] = MAGIC
+        self.load()
+
+    def map(self, columns, rows):
+        self.mmap = mmap.mmap(self.file.fileno(), 0)
+        self.header = np.frombuffer(self.mmap, _header, 1)[0:1]
+        self.columns = np.frombuffer(self.mmap, _column, columns, _header.itemsize)
+        self.rows = np.frombuffer(self.mmap, _row(columns), rows, _header.itemsize + columns * _column.itemsize)
+
+    def load(self):
+        """Reads the valid columns and rows."""
+        # symbol -> column
+        self.symbols = {}
+        for i, col in enumerate(self.columns):
+            if col['name'] and col['crc'] == self.column_crc(col['name'], col['since']):
+                self.symbols[col['name'].decode('utf-8')] = i
+        valid = [i for i, row in enumerate(self.rows)
+                 if row['tick'] and row['crc'] == self.row_crc(row['tick'], row['prices'])]
+        self.valid = np.zeros(len(self.rows), dtype=bool)
+        self.valid[valid] = True
+        self.newest = int(self.rows['tick'][self.valid].max()) if valid else 0
+
+    def column_crc(self, name, since):
+        return zlib.crc32(bytes(name) + int(since).to_bytes(8, 'little'))
+
+    def row_crc(self, tick, prices):
+        return zlib.crc32(prices.tobytes(), int(tick) & 0xffffffff)
+
+    def close(self):
+        if self.file is None:
+            return
+        if getattr(self, 'mmap', None) is not None:
+            # The numpy views keep the map alive; dropping them lets it close.
+            self.header = self.columns = self.rows = None
+            self.mmap.close()
+            self.mmap = None
+        self.file.close()
+        self.file = None
+
+    def clear(self):
+        """Forgets all ticks, e.g. after the server restarted."""
+        self.rows['tick'] = 0
+        self.columns['name'] = b''
+        self.symbols = {}
+        self.valid[:] = False
+        self.newest = 0
+
+    def assign(self, data, tick):
+        """Assigns columns to the symbols in data that have none."""
+        # Symbols too long for a column are not cached.
+        new = [sym for sym in data if not sym.startswith('_') and sym not in self.symbols
+               and len(sym.encode('utf-8')) <= 16]
+        if not new:
+            return
+        used = set(self.symbols.values())
+        free = [i for i in range(len(self.columns)) if i not in used]
+        for sym, i in list(self.symbols.items()):
+            if sym not in data:
+                self.symbols.pop(sym)
+                free.append(i)
+        if len(new) > len(free):
+            # More symbols than the cache has room for; start over with a bigger one.
+            self.create(max(2 * len(self.columns), len(self.symbols) + len(new)))
+            new = [sym for sym in data if not sym.startswith('_') and len(sym.encode('utf-8')) <= 16]
+            free = list(range(len(self.columns)))
+        for sym, i in zip(new, free):
+            name = sym.encode('utf-8')
+            col = self.columns[i:i + 1]
+            col['crc'] = 0
+            col['name'], col['since'] = name, tick
+            col['crc'] = self.column_crc(name, tick)
+            self.symbols[sym] = i
+
+    def write(self, data):
+        """Stores the prices of a tick (a stock data dict). Ticks older than the cache's ring
+        are ignored; symbols only get a column in ticks at least as new as any stored one."""
+        tick = data.get('_tick')
+        if not isinstance(tick, int) or tick <= 0 or tick <= self.newest - len(self.rows):
+            return
+        if tick >= self.newest:
+            self.assign(data, tick)
+        cols, values = [], []
+        for sym, upd in data.items():
+            i = self.symbols.get(sym)
+            if i is not None:
+                cols.append(i)
+                values.append(upd['price'])
+        cols, values = np.array(cols, dtype=np.int64), np.array(values, dtype=np.float32)
+        listed = self.columns['since'][cols] <= tick
+        prices = np.full(len(self.columns), np.nan, dtype=np.float32)
+        prices[cols[listed]] = values[listed]
+
+        r = tick % len(self.rows)
+        row = self.rows[r:r + 1]
+        row['tick'] = 0
+        row['prices'] = prices
+        row['crc'] = self.row_crc(tick, prices)
+        row['tick'] = tick
+        self.valid[r] = True
+        self.newest = max(self.newest, tick)
+
+    def history(self):
+        """Returns (ticks, {symbol: prices}) of the stored ticks, oldest first, for the symbols
+        listed in the newest one. Prices of ticks in which a symbol wasn't listed are NaN."""
+        rows = self.rows[self.valid]
+        rows = rows[np.argsort(rows['tick'])]
+        if not len(rows):
+            return rows['tick'], {}
+        newest = rows[-1]['prices']
+        prices = {}
+        for sym, i in self.symbols.items():
+            if np.isnan(newest[i]):
+                continue
+            p = rows['prices'][:, i].astype(np.float64)
+            p[rows['tick'] < self.columns[i]['since']] = np.nan
+            prices[sym] = p
+        return rows['tick'], prices
+
+    def flush(self):
+        self.mmap.flush()
+
+    def save_depot(self, snapshot):
+        """Atomically replaces the stored depot by snapshot (see Depot.snapshot())."""
+        tmp = self.path + '.depot.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path + '.depot')
+
+    def load_depot(self):
+        """Returns the stored depot snapshot, or None."""
+        try:
+            with open(self.path + '.depot') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
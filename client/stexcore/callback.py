@@ -0,0 +1,271 @@
+"""The callback channel for requests to the stex server."""
+
+import json
+import os
+import time
+
+import zmq
+
+from .feed import endpoints
+from .signal import Signal
+
+
+class PendingRequest:
+    """PendingRequest is a request sent (or about to be sent) on the CallbackChannel."""
+    id = 0
+    payload = ''
+    # Permanent requests (orders, login) are retried; others (depot summaries) may be dropped.
+    permanent = True
+    # Key under which non-permanent requests are coalesced; only the newest one is kept.
+    coalesce = None
+    sent_at = 0
+    retries = 0
+
+    def __init__(self, id, payload, permanent, coalesce=None):
+        self.id = id
+        self.payload = payload
+        self.permanent = permanent
+        self.coalesce = coalesce
+
+
+class CallbackChannel:
+    """CallbackChannel sends messages to the stex server and receives responses.
+
+    It uses a DEALER socket, so several requests can be in flight at the same time. Every
+    request carries an ID which the server echoes, and responses are matched to their request
+    by that ID, in whatever order they arrive. Requests that aren't answered in time are
+    retried; nothing here ever blocks.
+
+    The channel doesn't run an event loop. Its owner calls receive() when fileno() is
+    readable, and check_timeouts() every now and then. The ZMQ FD is edge-triggered and any
+    send may consume its edge, so the channel also handles the responses waiting after each of
+    its own sends -- a response may thus be handled before try_send() returns.
+
+    Requests are sent with the channel's creds unless others are given, so one channel can
+    carry the requests of many users.
+    """
+    creds = None
+    socket = None
+    # Request ID -> PendingRequest, for requests that were sent but not yet answered.
+    inflight = None
+    # PendingRequests waiting for a free in-flight slot.
+    queue = None
+    next_id = 1
+    # Random ID of this channel, sent with every request. Request IDs start at 1 in every
+    # channel, so the server tells requests of different channels apart by it.
+    session = ''
+    # Whether receive() is running, so that sending from its handlers doesn't recurse into it.
+    receiving = False
+
+    MAX_INFLIGHT = 8
+    MAX_QUEUE = 256
+    TIMEOUT_MS = 2000
+    MAX_RETRIES = 3
+
+    def __init__(self, zctx, creds, max_inflight=None, max_queue=None):
+        self.creds = creds
+        self.session = os.urandom(8).hex()
+        self.inflight = {}
+        self.queue = []
+        if max_inflight:
+            self.MAX_INFLIGHT = max_inflight
+        if max_queue:
+            self.MAX_QUEUE = max_queue
+
+        self.newGroupInfo = Signal()
+        # Emitted with the server's view of the account after logging in.
+        self.accountInfo = Signal()
+        # Emitted with the server's response to a depot message.
+        self.depotAcknowledged = Signal()
+        # Emitted with the execution result of an order.
+        self.orderExecuted = Signal()
+        # Emitted with (request ID, original message, error) of a permanent request that was
+        # given up on; error is the server's, or None if the server didn't answer.
+        self.requestFailed = Signal()
+        # Emitted with (request ID, response) for every response matched to a request.
+        self.response = Signal()
+        # Emitted with the list of stock data dicts the server returned for a history request.
+        self.historyReceived = Signal()
+        # Emitted with True if the server considers our feed subscription too slow, and with
+        # False once it has caught up.
+        self.feedSlow = Signal()
+
+        socket = zctx.socket(zmq.DEALER)
+        socket.setsockopt(zmq.IPV6, 1)
+        socket.setsockopt(zmq.RCVTIMEO, 0)
+        socket.setsockopt(zmq.SNDTIMEO, 0)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(endpoints(creds.addr)[1])
+        self.socket = socket
+
+    def fileno(self):
+        return self.socket.getsockopt(zmq.FD)
+
+    def login(self, creds=None):
+        return self.try_send({'_stocklogin': True}, creds=creds)
+
+    def send_depot(self, depot, creds=None, feed=None):
+        """Sends a depot summary, along with the statistics of feed if given."""
+        summary = depot.to_delta()
+        if feed is not None:
+            summary['feed'] = feed.stats()
+        # Only the newest depot summary is worth sending; older ones are replaced.
+        return self.try_send(summary, permanent=False, coalesce=('depot', (creds or self.creds).user),
+                             creds=creds)
+
+    def request_history(self, since, creds=None):
+        """Asks for the recent ticks after tick since, to fill a gap in the client's history."""
+        return self.try_send({'_stockhistory': True, 'since': since}, permanent=False,
+                             coalesce=('history', (creds or self.creds).user), creds=creds)
+
+    def send_order(self, order, creds=None):
+        """order should contain the keys 'symbol', 'qty'."""
+        order['type'] = 'order'
+        return self.try_send(order, permanent=True, creds=creds)
+
+    def wrap(self, msg, type, id, creds=None):
+        creds = creds or self.creds
+        return json.dumps({
+            '_stockcallback': True,
+            'id': id,
+            'session': self.session,
+            'user': creds.user,
+            'password': creds.password,
+            'group': creds.group,
+            'market': creds.market,
+            'type': type,
+            'msg': msg,
+        })
+
+    def try_send(self, msg, permanent=True, coalesce=None, creds=None):
+        """Queue msg for sending and send as much of the queue as possible. Returns the request ID."""
+        id = self.next_id
+        self.next_id += 1
+        req = PendingRequest(id, self.wrap(msg, msg.get('type', 'callback'), id, creds), permanent, coalesce)
+
+        if coalesce is not None:
+            self.queue = [q for q in self.queue if q.coalesce != coalesce]
+        if len(self.queue) >= self.MAX_QUEUE:
+            self.drop_from_queue()
+        self.queue.append(req)
+        self.flush()
+        return id
+
+    def drop_from_queue(self):
+        """Makes room in a full queue, preferring to drop non-permanent requests."""
+        for i, q in enumerate(self.queue):
+            if not q.permanent:
+                self.queue.pop(i)
+                return
+        dropped = self.queue.pop(0)
+        print('DEBUG: Callback queue full, dropping request', dropped.id)
+        self.requestFailed.emit(dropped.id, json.loads(dropped.payload).get('msg', {}), None)
+
+    def flush(self):
+        """Sends queued requests until the in-flight window is full or the socket would block,
+        then handles the responses waiting."""
+        self.send_queued()
+        if self.readable():
+            self.receive()
+
+    def send_queued(self):
+        while self.queue and len(self.inflight) < self.MAX_INFLIGHT:
+            req = self.queue[0]
+            if not self.send_request(req):
+                return
+            self.queue.pop(0)
+            self.inflight[req.id] = req
+
+    def readable(self):
+        """Returns whether responses are waiting, regardless of the state of the FD."""
+        try:
+            return bool(self.socket.getsockopt(zmq.EVENTS) & zmq.POLLIN)
+        except zmq.ZMQError:
+            return False
+
+    def send_request(self, req):
+        try:
+            # The empty delimiter frame gives the server the same envelope a REQ socket would.
+            self.socket.send_multipart([b'', req.payload.encode('utf-8')], flags=zmq.NOBLOCK)
+            req.sent_at = time.monotonic()
+            return True
+        except zmq.Again:
+            return False
+        except Exception as e:
+            print('DEBUG: Send failed on DEALER socket: ', e)
+            return False
+
+    def check_timeouts(self):
+        """Retries or gives up on requests that weren't answered in time."""
+        now = time.monotonic()
+        for id, req in list(self.inflight.items()):
+            if (now - req.sent_at) * 1000 < self.TIMEOUT_MS:
+                continue
+            if req.permanent and req.retries < self.MAX_RETRIES:
+                req.retries += 1
+                self.send_request(req)
+                continue
+            self.inflight.pop(id)
+            if req.permanent:
+                print('DEBUG: Giving up on request', id)
+                self.requestFailed.emit(req.id, json.loads(req.payload).get('msg', {}), None)
+        self.flush()
+
+    def receive(self):
+        """Handles all responses received so far, and sends what the freed in-flight slots
+        allow. The ZMQ FD is edge-triggered, so this has to drain the socket every time, and
+        again after sending."""
+        if self.receiving:
+            return
+        self.receiving = True
+        try:
+            while True:
+                self.drain()
+                self.send_queued()
+                if not self.readable():
+                    break
+        finally:
+            self.receiving = False
+
+    def drain(self):
+        while True:
+            try:
+                frames = self.socket.recv_multipart(flags=zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            except Exception as e:
+                print('DEBUG: RECV failed on DEALER socket: ', e)
+                return
+            try:
+                msg = json.loads(frames[-1].decode())
+            except ValueError as e:
+                print('DEBUG: Invalid response: ', e)
+                continue
+            self.handle_reply(msg)
+
+    def handle_reply(self, msg):
+        if not isinstance(msg, dict):
+            return
+        if '_stockexec' in msg:
+            # Sent by the server whenever an order is executed, not in response to a request.
+            self.orderExecuted.emit(msg)
+            return
+        req = self.inflight.pop(msg.get('id'), None)
+        if req is None and 'id' in msg:
+            # Reply to a request that was already retried and answered, or given up on.
+            return
+        if req is not None:
+            self.response.emit(req.id, msg)
+        if '_stockresp' in msg and 'groupinfo' in msg:
+            self.newGroupInfo.emit(msg['groupinfo'])
+        if '_stockresp' in msg and ('resync' in msg or 'version' in msg):
+            self.depotAcknowledged.emit(msg)
+        if '_stockresp' in msg and 'history' in msg:
+            self.historyReceived.emit([json.loads(tick) for tick in msg['history']])
+        if '_stockresp' in msg and 'slow' in msg:
+            self.feedSlow.emit(msg['slow'])
+        if '_stockresp' in msg and 'account' in msg:
+            self.accountInfo.emit(msg['account'])
+        if msg.get('ok') is False and req is not None and req.permanent:
+            print('DEBUG: Request {} failed: {}'.format(req.id, msg.get('error')))
+            self.requestFailed.emit(req.id, json.loads(req.payload).get('msg', {}), msg.get('error'))
@@ -0,0 +1,283 @@
+"""Depot accounting."""
+
+import numpy as np
+
+from .signal import Signal
+
+
+class Depot:
+    """Depot contains several DepotStocks and manages buying/selling them.
+
+    Holdings are kept in arrays indexed by symbol: the number of pieces, the current price and
+    the cost basis (total buy price) of every stock. The value of all holdings is a running
+    sum, adjusted by the change of every position and price, so a tick costs O(symbols in the
+    tick) and total_value() is O(1). Slots of removed stocks are reused.
+
+    Every change to cash or holdings increments the depot's version. The server acknowledges the
+    versions it has seen, so only what changed since then needs to be sent (see to_delta()).
+    """
+    cash = 0
+    # symbol -> DepotStock
+    stock = None
+    version = 0
+    # Last version acknowledged by the server; 0 if the server needs a full depot.
+    synced_version = 0
+    # symbol -> version in which the holding last changed; None is the cash.
+    changed_at = None
+    # Number of the last tick applied.
+    tick = 0
+
+    def __init__(self, capacity=64):
+        self.stock = {}
+        self.changed_at = {}
+        # symbol -> slot in the arrays, and slot -> symbol (None if free).
+        self.symbols = {}
+        self.names = [None] * capacity
+        self.nums = np.zeros(capacity, dtype=np.int64)
+        self.prices = np.zeros(capacity, dtype=np.float64)
+        self.costs = np.zeros(capacity, dtype=np.float64)
+        # Value of all holdings at the current prices, i.e. sum(nums * prices).
+        self.value = 0.0
+        self._free = list(range(capacity - 1, -1, -1))
+        # Emitted with the symbol whose price was updated.
+        self.priceUpdated = Signal()
+        # Emitted once for every change of cash or holdings, and once per tick.
+        self.depotChanged = Signal()
+        # Emitted with the symbol whose holding changed through an execution.
+        self.positionChanged = Signal()
+        # Emitted with (symbol, qty) when an order should be sent to the server.
+        self.orderRequested = Signal()
+        # symbol -> ticks of its last splits, and the tick of the position last reported by
+        # the server if that is newer than the last tick applied.
+        self.splits = {}
+        self.ahead = {}
+
+    def _grow(self):
+        n = len(self.nums)
+        self.nums = np.concatenate([self.nums, np.zeros(n, dtype=np.int64)])
+        self.prices = np.concatenate([self.prices, np.zeros(n, dtype=np.float64)])
+        self.costs = np.concatenate([self.costs, np.zeros(n, dtype=np.float64)])
+        self.names.extend([None] * n)
+        self._free.extend(range(2 * n - 1, n - 1, -1))
+
+    def add_stock(self, stocksym):
+        """Returns the DepotStock of stocksym, adding it if necessary."""
+        stock = self.stock.get(stocksym)
+        if stock is None:
+            if not self._free:
+                self._grow()
+            stock = DepotStock(self, stocksym, self._free.pop())
+            self.symbols[stocksym] = stock.slot
+            self.names[stock.slot] = stocksym
+            self.stock[stocksym] = stock
+        return stock
+
+    def remove_stock(self, stocksym):
+        if stocksym not in self.stock:
+            return
+        i = self.symbols.pop(stocksym)
+        self.stock.pop(stocksym)
+        self.splits.pop(stocksym, None)
+        self.ahead.pop(stocksym, None)
+        self.names[i] = None
+        if self.nums[i]:
+            self.touch(stocksym)
+        self.value -= self.nums[i] * self.prices[i]
+        self.nums[i], self.prices[i], self.costs[i] = 0, 0, 0
+        self._free.append(i)
+
+    def touch(self, stocksym=None):
+        """Records a change of the holding of stocksym, or of the cash if stocksym is None."""
+        self.version += 1
+        self.changed_at[stocksym] = self.version
+
+    def place_order(self, stocksym, num):
+        """Requests buying (num > 0) or selling (num < 0) stock. The depot only changes once
+        the server reports the execution."""
+        if stocksym not in self.stock or num == 0:
+            return False
+        self.orderRequested.emit(stocksym, num)
+        return True
+
+    def apply_execution(self, result):
+        """Applies an execution result reported by the server.
+
+        The resulting position is taken from the server, which reports it as of the tick the
+        order was executed in. The feed and the execution results arrive independently, so that
+        tick's splits may be applied here before or after the result; the position is adjusted
+        by the splits it doesn't match, and fills never have to agree with the local holding."""
+        sym = result.get('symbol')
+        if result.get('qty') and sym in self.stock:
+            i = self.symbols[sym]
+            old, qty = int(self.nums[i]), result['qty']
+            num, tick = result.get('num', max(old + qty, 0)), result.get('tick')
+            if isinstance(tick, int) and 'num' in result:
+                if tick > self.tick:
+                    # The position already includes the splits of ticks not applied yet.
+                    self.ahead[sym] = max(tick, self.ahead.get(sym, 0))
+                else:
+                    num *= 2 ** sum(1 for t in self.splits.get(sym, ()) if t > tick)
+            if qty > 0:
+                self.costs[i] += qty * (self.prices[i] if result.get('price') is None else result['price'])
+            elif old:
+                # Sales reduce the cost basis at the average buy price.
+                self.costs[i] *= min(num / old, 1)
+            if num == 0:
+                self.costs[i] = 0
+            self.nums[i] = num
+            self.value += (num - old) * self.prices[i]
+            self.touch(sym)
+            self.positionChanged.emit(sym)
+        if 'cash' in result and result['cash'] != self.cash:
+            self.cash = result['cash']
+            self.touch()
+        self.depotChanged.emit()
+
+    def load_account(self, account):
+        """Replaces cash and holdings by the server's view of the account."""
+        self.cash = account.get('cash', self.cash)
+        held = {sym: stock.get('num', 0) for sym, stock in account.get('stock', {}).items()}
+        for sym, i in list(self.symbols.items()):
+            if sym not in held and self.nums[i]:
+                held[sym] = 0
+        for sym, num in held.items():
+            i = self.add_stock(sym).slot
+            if num == 0:
+                self.costs[i] = 0
+            self.nums[i] = num
+            self.positionChanged.emit(sym)
+        self.revalue()
+        # The server may hold an older depot than this; send everything next time.
+        self.touch()
+        self.synced_version = 0
+        self.depotChanged.emit()
+
+    def snapshot(self):
+        """Returns cash, holdings and cost bases, to be restored with restore()."""
+        nums, costs = self.nums.tolist(), self.costs.tolist()
+        return {'cash': self.cash, 'version': self.version,
+                'stock': {sym: {'num': nums[i], 'cost': costs[i]} for sym, i in self.symbols.items() if nums[i]}}
+
+    def restore(self, snapshot):
+        """Restores a snapshot. The server's view of the account still replaces it once known,
+        but the cost bases are only kept by the client."""
+        self.cash = snapshot.get('cash', self.cash)
+        self.version = max(self.version, snapshot.get('version', 0))
+        for sym, stock in snapshot.get('stock', {}).items():
+            i = self.add_stock(sym).slot
+            self.nums[i], self.costs[i] = stock.get('num', 0), stock.get('cost', 0)
+            self.positionChanged.emit(sym)
+        self.revalue()
+        self.synced_version = 0
+        self.depotChanged.emit()
+
+    def update(self, message):
+        """Takes the prices of a tick, and doubles the holdings of split stocks."""
+        tick = message.get('_tick')
+        if isinstance(tick, int):
+            self.tick = tick
+        syms, slots, prices, split = [], [], [], []
+        for sym, upd in message.items():
+            i = self.symbols.get(sym)
+            if i is None:
+                continue
+            syms.append(sym)
+            slots.append(i)
+            prices.append(upd['price'])
+            if upd.get('split') and isinstance(tick, int):
+                self.splits[sym] = self.splits.get(sym, [])[-7:] + [tick]
+            # Positions reported by the server for this tick or later already include its split.
+            split.append(bool(upd.get('split')) and not (isinstance(tick, int) and self.ahead.get(sym, 0) >= tick))
+            if isinstance(tick, int) and self.ahead.get(sym, tick) <= tick:
+                self.ahead.pop(sym, None)
+        if not slots:
+            return
+        slots = np.array(slots, dtype=np.int64)
+        split = slots[np.array(split, dtype=bool)]
+        before = self.nums[slots] * self.prices[slots]
+
+        self.prices[slots] = prices
+        # A split doubles the pieces, at the same cost basis.
+        for i in split[self.nums[split] != 0]:
+            self.touch(self.names[i])
+        self.nums[split] *= 2
+        self.value += (self.nums[slots] * self.prices[slots] - before).sum()
+
+        for sym in syms:
+            self.priceUpdated.emit(sym)
+        self.depotChanged.emit()
+
+    def revalue(self):
+        """Recomputes the value of all holdings from scratch."""
+        self.value = float(self.nums @ self.prices)
+        return self.value
+
+    def total_value(self):
+        return float(self.value)
+
+    def to_dict(self):
+        s = {'cash': self.cash, 'value': self.cash + self.total_value(), 'stock': {}, '_stockdepot': True}
+        nums = self.nums.tolist()
+        for sym, i in self.symbols.items():
+            if nums[i]:
+                s['stock'][sym] = {'num': nums[i]}
+        return s
+
+    def to_delta(self):
+        """Returns a depot message containing only what changed since the version last
+        acknowledged by the server, or the full depot if the server has none. If nothing
+        changed, the message only carries the version."""
+        if self.synced_version == 0:
+            s = self.to_dict()
+            s.pop('value')
+            s.update({'version': self.version, 'full': True})
+            return s
+        s = {'_stockdepot': True, 'version': self.version, 'base': self.synced_version}
+        if self.version == self.synced_version:
+            return s
+        stock = {}
+        for sym, version in self.changed_at.items():
+            if version <= self.synced_version:
+                continue
+            if sym is None:
+                s['cash'] = self.cash
+            else:
+                stock[sym] = {'num': int(self.nums[self.symbols[sym]]) if sym in self.symbols else 0}
+        if stock:
+            s['stock'] = stock
+        return s
+
+    def acknowledge(self, resp):
+        """Processes the server's response to a depot message."""
+        if resp.get('resync'):
+            self.synced_version = 0
+        elif resp.get('version', 0) > self.synced_version:
+            self.synced_version = resp['version']
+            # Forget changes the server has seen by now.
+            self.changed_at = {sym: v for sym, v in self.changed_at.items() if v > self.synced_version}
+
+
+class DepotStock:
+    """DepotStock is a position of stock in a single company in the depot: a view of the
+    depot's arrays at the stock's slot."""
+    sym = ''
+
+    def __init__(self, depot, sym, slot):
+        self.depot = depot
+        self.sym = sym
+        self.slot = slot
+
+    @property
+    def current_price(self):
+        return float(self.depot.prices[self.slot])
+
+    @property
+    def current_num(self):
+        return int(self.depot.nums[self.slot])
+
+    @property
+    def total_buy_price(self):
+        return float(self.depot.costs[self.slot])
+
+    def avg_buy_price(self):
+        return self.total_buy_price / (self.current_num or 1)
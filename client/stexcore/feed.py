@@ -0,0 +1,130 @@
+"""Subscription to the stock data feed."""
+
+import json
+
+import zmq
+
+from .signal import Signal
+
+
+class Creds:
+    user = ''
+    password = ''
+    addr = ''
+    group = ''
+    # Market to play in, on servers hosting several; '' is the default market.
+    market = ''
+
+    def __init__(self, user='', password='', addr='', group='', market=''):
+        self.user = user
+        self.password = password
+        self.addr = addr
+        self.group = group
+        self.market = market
+
+
+def endpoints(addr):
+    """Returns the (feed, callback) ZMQ endpoints of the server at addr.
+
+    addr is either host:port, for TCP, or a ZMQ endpoint (tcp://, ipc:// or inproc://). The
+    callback socket of a TCP server listens on the port above the feed's; that of an IPC or
+    in-process server at the feed's endpoint with .callback appended."""
+    if '://' not in addr:
+        addr = 'tcp://' + (addr if ':' in addr else '{}:9988'.format(addr or 'localhost'))
+    transport, _, where = addr.partition('://')
+    if transport != 'tcp':
+        return addr, addr + '.callback'
+    host, _, port = where.rpartition(':')
+    return addr, 'tcp://{}:{}'.format(host, int(port) + 1)
+
+
+class FeedSocket:
+    """FeedSocket receives stock data from the server's PUB socket.
+
+    It never blocks: whoever runs the event loop polls fileno() (or the socket itself) and
+    calls receive() when it is readable.
+
+    Ticks are numbered, so the socket counts the ticks it missed, be it because the server or
+    this socket dropped them when the subscriber fell behind. The first tick after a gap is
+    marked with '_gap', as the listing events of the missed ticks are lost. A socket told to
+    conflate skips all but the newest of the ticks waiting in one receive(), except those with
+    splits or listing events.
+    """
+    zctx = None
+    sock = None
+    # Number of the newest tick received, the number of ticks received and missed.
+    last_tick = 0
+    received = 0
+    dropped = 0
+    conflate = False
+
+    def __init__(self, zctx, creds, hwm=None):
+        self.zctx = zctx
+        # Emitted with every stock data dict received.
+        self.newData = Signal()
+        self.sock = self.zctx.socket(zmq.SUB)
+        self.sock.setsockopt(zmq.IPV6, 1)
+        if hwm:
+            self.sock.setsockopt(zmq.RCVHWM, hwm)
+        # Named markets are published with their name and a space as topic frame, the default
+        # market as bare JSON; subscribing to '' would receive all markets.
+        self.sock.subscribe(creds.market + ' ' if creds.market else '{')
+        self.sock.setsockopt(zmq.RCVTIMEO, 0)
+        self.sock.connect(endpoints(creds.addr)[0])
+
+    def fileno(self):
+        return self.sock.getsockopt(zmq.FD)
+
+    def set_conflate(self, conflate):
+        self.conflate = conflate
+
+    def keep(self, msg):
+        """Returns whether msg must be delivered even when conflating."""
+        return '_events' in msg or any(isinstance(u, dict) and u.get('split') for u in msg.values())
+
+    def stats(self):
+        """Returns the feed statistics reported to the server."""
+        return {'tick': self.last_tick, 'received': self.received, 'dropped': self.dropped}
+
+    def count(self, msg):
+        """Counts the ticks missed before msg, and marks msg with '_gap' if the feed isn't
+        continuous."""
+        tick = msg.get('_tick')
+        if not isinstance(tick, int):
+            return
+        if self.last_tick and tick > self.last_tick + 1:
+            self.dropped += tick - self.last_tick - 1
+            msg['_gap'] = True
+        elif self.last_tick and tick <= self.last_tick:
+            # The server restarted, or seeked in a replay.
+            msg['_gap'] = True
+        self.last_tick = tick
+
+    def receive(self):
+        """Emits newData for all stock data received so far. Returns the number of messages.
+        The ZMQ FD is edge-triggered, so this has to drain the socket every time."""
+        n, msgs = 0, []
+        while True:
+            try:
+                msg = json.loads(self.sock.recv_multipart(flags=zmq.NOBLOCK)[-1].decode())
+            except zmq.Again:
+                break
+            except Exception as e:
+                print('DEBUG: Invalid stock data: ', e)
+                continue
+            if '_stockdata' not in msg:
+                continue
+            n += 1
+            self.received += 1
+            self.count(msg)
+            if not self.conflate:
+                self.newData.emit(msg)
+                continue
+            if msgs and not self.keep(msgs[-1]):
+                # The newer tick replaces it, but has to carry on a gap before it.
+                if msgs.pop().get('_gap'):
+                    msg['_gap'] = True
+            msgs.append(msg)
+        for msg in msgs:
+            self.newData.emit(msg)
+        return n
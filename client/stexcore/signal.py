@@ -0,0 +1,19 @@
+"""A minimal replacement for Qt signals."""
+
+
+class Signal:
+    """Signal calls all connected functions when emitted, like a pyqtSignal but without Qt.
+    Qt slots can be connected to it as well."""
+
+    def __init__(self):
+        self.slots = []
+
+    def connect(self, slot):
+        self.slots.append(slot)
+
+    def disconnect(self, slot):
+        self.slots.remove(slot)
+
+    def emit(self, *args):
+        for slot in self.slots:
+            slot(*args)
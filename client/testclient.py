@@ -16,6 +16,8 @@ while True:
     msg = sock.recv_json()
     msg.pop('_stockdata')
     for sym, val in sorted(msg.items()):
+        if sym.startswith('_'):
+            continue
         if 'price' not in val:
             print('invalid item: ', val)
         price = val['price']
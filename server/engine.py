@@ -0,0 +1,244 @@
+"""The execution engine keeps the authoritative depot of every user and fills their orders."""
+
+import collections
+
+import numpy as np
+
+# Cash in cents every new account starts with.
+INITIAL_CASH = 1000000
+# Number of ticks an unfilled limit order rests in the book before it expires.
+ORDER_TTL = 600
+# Number of recent order IDs remembered per account, to ignore retransmitted orders.
+_seen_orders = 1024
+# Returned by ExecutionEngine.submit() for a retransmission of an order it already has.
+DUPLICATE = 'duplicate'
+
+
+class Account:
+    """Account is a user's cash and positions as seen by the server."""
+
+    def __init__(self, cash=INITIAL_CASH):
+        self.cash = cash
+        # symbol -> number of pieces held.
+        self.positions = {}
+        self.seen = collections.deque(maxlen=_seen_orders)
+
+    def to_dict(self):
+        return {'cash': self.cash, 'stock': {sym: {'num': num} for sym, num in self.positions.items()}}
+
+
+def _group_cumsum(keys, values):
+    """Returns the running sum of values within each group of equal keys, in the original order."""
+    if len(keys) == 0:
+        return values.copy()
+    order = np.argsort(keys, kind='stable')
+    k, v = keys[order], values[order]
+    total = np.cumsum(v)
+    starts = np.flatnonzero(np.r_[True, k[1:] != k[:-1]])
+    # Subtract everything accumulated before the start of each group.
+    before = np.repeat(total[starts] - v[starts], np.diff(np.r_[starts, len(k)]))
+    out = np.empty_like(total)
+    out[order] = total - before
+    return out
+
+
+class ExecutionEngine:
+    """ExecutionEngine collects orders between ticks and executes them in one batch against
+    the prices of the next tick.
+
+    An order is a dict with the keys 'symbol' and 'qty' (positive to buy, negative to sell),
+    and optionally 'limit', a price in cents. Market orders are filled at the tick price as far
+    as the user's cash or holdings allow; limit orders are filled once the tick price reaches
+    the limit, and rest in the book until then. Sells are executed before buys, so the proceeds
+    of a sale can be used within the same tick.
+    """
+
+    def __init__(self, initial_cash=INITIAL_CASH):
+        self.initial_cash = initial_cash
+        self.accounts = {}
+        # symbol -> set of users holding it; used to apply splits and delistings.
+        self.holders = collections.defaultdict(set)
+        # Users whose cash or positions were changed by orders in the last tick.
+        self.touched = set()
+        self.tick = 0
+        # Pending orders as parallel lists, for cheap appends and array conversion.
+        self._users = []
+        self._symbols = []
+        self._qtys = []
+        self._limits = []
+        self._expiry = []
+        # (reply address, order ID) per pending order.
+        self._origins = []
+
+    def account(self, user):
+        """Returns the account of user, opening it if necessary."""
+        acct = self.accounts.get(user)
+        if acct is None:
+            acct = Account(self.initial_cash)
+            self.accounts[user] = acct
+        return acct
+
+    def pending(self):
+        return len(self._users)
+
+    def submit(self, user, order, origin=None, order_id=None, session=None):
+        """Queues an order for execution at the next tick. Returns None if the order was
+        accepted, DUPLICATE if it was accepted before, or an error string. origin is passed back
+        with the execution result.
+
+        Order IDs are only unique within the session of a client, which starts counting anew
+        when it is restarted, so retransmissions are recognized by (session, order_id)."""
+        symbol, qty, limit = order.get('symbol'), order.get('qty'), order.get('limit')
+        if not isinstance(symbol, str) or not symbol:
+            return 'missing symbol'
+        if not isinstance(qty, int) or isinstance(qty, bool) or qty == 0:
+            return 'qty must be a non-zero integer'
+        if limit is not None and (not isinstance(limit, (int, float)) or limit <= 0):
+            return 'limit must be a positive price'
+
+        acct = self.account(user)
+        if order_id is not None:
+            if (session, order_id) in acct.seen:
+                # Retransmission of an order we already have.
+                return DUPLICATE
+            acct.seen.append((session, order_id))
+
+        self._users.append(user)
+        self._symbols.append(symbol)
+        self._qtys.append(qty)
+        self._limits.append(np.nan if limit is None else float(limit))
+        self._expiry.append(self.tick + ORDER_TTL)
+        self._origins.append((origin, order_id))
+        return None
+
+    def apply_corporate_actions(self, stockdata):
+        """Doubles positions in split stocks and removes positions in stocks that are gone."""
+        for sym, upd in stockdata.items():
+            if sym.startswith('_') or not upd.get('split'):
+                continue
+            for user in self.holders.get(sym, ()):
+                self.accounts[user].positions[sym] *= 2
+        for sym in [s for s in self.holders if s not in stockdata]:
+            for user in self.holders.pop(sym):
+                self.accounts[user].positions.pop(sym, None)
+
+    def execute(self, stockdata):
+        """Advances the engine by one tick with the prices in stockdata (a StockData dict).
+        Returns a list of (origin, result) for every order that was filled, rejected or expired."""
+        self.tick += 1
+        self.touched = set()
+        self.apply_corporate_actions(stockdata)
+        if not self._users:
+            return []
+
+        users, symbols = self._users, self._symbols
+        n = len(users)
+        qty = np.array(self._qtys, dtype=np.int64)
+        limit = np.array(self._limits, dtype=np.float64)
+        expiry = np.array(self._expiry, dtype=np.int64)
+        price = np.array([stockdata[s]['price'] if s in stockdata and not s.startswith('_') else np.nan
+                          for s in symbols], dtype=np.float64)
+
+        # Dense indices for users and (user, symbol) pairs.
+        user_names, user_idx = np.unique(np.array(users, dtype=object), return_inverse=True)
+        pair_names = {}
+        pair_idx = np.array([pair_names.setdefault((u, s), len(pair_names)) for u, s in zip(users, symbols)],
+                            dtype=np.int64)
+        accts = [self.accounts[u] for u in user_names]
+        pairs = list(pair_names)
+
+        listed = ~np.isnan(price)
+        buy, sell = qty > 0, qty < 0
+        with np.errstate(invalid='ignore'):
+            marketable = listed & (np.isnan(limit) | (buy & (price <= limit)) | (sell & (price >= limit)))
+        filled = np.zeros(n, dtype=np.int64)
+
+        # Sells: every (user, symbol) pair can sell at most its current position.
+        held = np.array([self.accounts[u].positions.get(s, 0) for u, s in pairs], dtype=np.int64)
+        want = np.where(marketable & sell, -qty, 0)
+        before = _group_cumsum(pair_idx, want) - want
+        sold = np.clip(held[pair_idx] - before, 0, want)
+        filled -= sold
+        proceeds = np.bincount(user_idx, weights=sold * np.nan_to_num(price), minlength=len(accts))
+
+        # Buys: every user can spend at most their cash, including this tick's proceeds.
+        cash = np.array([a.cash for a in accts], dtype=np.float64) + proceeds
+        want = np.where(marketable & buy, qty, 0)
+        cost = want * np.nan_to_num(price)
+        spent_before = _group_cumsum(user_idx, cost) - cost
+        avail = cash[user_idx] - spent_before
+        with np.errstate(divide='ignore', invalid='ignore'):
+            affordable = np.where(want > 0, np.floor(avail / np.maximum(price, 1)), 0)
+        bought = np.clip(affordable, 0, want).astype(np.int64)
+        filled += bought
+        cash -= np.bincount(user_idx, weights=bought * np.nan_to_num(price), minlength=len(accts))
+
+        # Write back cash and positions.
+        for u, a, c in zip(user_names, accts, cash):
+            if a.cash != c:
+                a.cash = float(c)
+                self.touched.add(u)
+        delta = np.bincount(pair_idx, weights=filled, minlength=len(pairs)).astype(np.int64)
+        for (u, s), d in zip(pairs, delta):
+            if d == 0:
+                continue
+            self.touched.add(u)
+            positions = self.accounts[u].positions
+            num = positions.get(s, 0) + int(d)
+            if num:
+                positions[s] = num
+                self.holders[s].add(u)
+            else:
+                positions.pop(s, None)
+                self.holders[s].discard(u)
+
+        # Orders that were marketable are done, whether (partially) filled or not. Limit orders
+        # that weren't reached rest until they expire; orders for unknown symbols are rejected.
+        expired = ~marketable & listed & (expiry <= self.tick)
+        done = marketable | ~listed | expired
+        results = []
+        for i in np.flatnonzero(done):
+            acct = accts[user_idx[i]]
+            if not listed[i]:
+                status = 'rejected'
+            elif expired[i]:
+                status = 'expired'
+            elif filled[i] == 0:
+                status = 'rejected'
+            elif filled[i] == qty[i]:
+                status = 'filled'
+            else:
+                status = 'partial'
+            origin, order_id = self._origins[i]
+            results.append((origin, {
+                '_stockexec': True,
+                'id': order_id,
+                'symbol': symbols[i],
+                'qty': int(filled[i]),
+                'price': float(price[i]) if listed[i] else None,
+                'status': status,
+                'cash': acct.cash,
+                # The resulting position, after the splits and delistings of the tick.
+                'num': acct.positions.get(symbols[i], 0),
+                'tick': stockdata.get('_tick'),
+            }))
+
+        keep = np.flatnonzero(~done)
+        self._users = [users[i] for i in keep]
+        self._symbols = [symbols[i] for i in keep]
+        self._qtys = [self._qtys[i] for i in keep]
+        self._limits = [self._limits[i] for i in keep]
+        self._expiry = [self._expiry[i] for i in keep]
+        self._origins = [self._origins[i] for i in keep]
+        return results
+
+    def value(self, user, stockdata):
+        """Returns cash plus the value of all positions of user at the prices in stockdata."""
+        acct = self.accounts.get(user)
+        if acct is None:
+            return None
+        value = acct.cash
+        for sym, num in acct.positions.items():
+            if sym in stockdata:
+                value += num * stockdata[sym]['price']
+        return value
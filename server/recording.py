@@ -0,0 +1,103 @@
+"""Recording and replaying of published ticks.
+
+A recording starts with a magic header followed by one record per published tick:
+
+    length of payload (u32) | tick (u64) | ns since start of recording (u64) | length of topic (u16)
+    topic | zlib-compressed payload
+
+A record cut short, for example because the recording server was killed, ends the recording.
+"""
+
+import mmap
+import struct
+import time
+import zlib
+
+import numpy as np
+
+MAGIC = b'STEXREC1'
+_record = struct.Struct('<IQQH')
+# Recorded ticks are flushed to disk at least this often.
+_flush_interval_ns = 1000000000
+
+
+class Recorder:
+    """Recorder appends published ticks to a recording file."""
+
+    def __init__(self, path, level=6):
+        self.out = open(path, 'wb')
+        self.out.write(MAGIC)
+        self.level = level
+        self.start = time.monotonic_ns()
+        self.flushed = self.start
+
+    def write(self, topic, tick, payload):
+        """Records a tick. topic is the topic frame (bytes) or None, payload the serialized tick."""
+        topic = topic or b''
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        compressed = zlib.compress(payload, self.level)
+        now = time.monotonic_ns()
+        self.out.write(_record.pack(len(compressed), tick, now - self.start, len(topic)))
+        self.out.write(topic)
+        self.out.write(compressed)
+        if now - self.flushed > _flush_interval_ns:
+            self.flush()
+            self.flushed = now
+
+    def flush(self):
+        self.out.flush()
+
+    def close(self):
+        self.out.close()
+
+
+class Recording:
+    """Recording gives random access to the ticks of a memory-mapped recording file."""
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError('{} is not a stex recording'.format(path))
+        self.index()
+
+    def index(self):
+        """Scans the record headers, without touching the payloads."""
+        offsets, ticks, times = [], [], []
+        self.topics = set()
+        pos, end = len(MAGIC), len(self.map)
+        while pos + _record.size <= end:
+            length, tick, ns, topiclen = _record.unpack_from(self.map, pos)
+            if pos + _record.size + topiclen + length > end:
+                break
+            offsets.append(pos)
+            ticks.append(tick)
+            times.append(ns)
+            self.topics.add(bytes(self.map[pos + _record.size:pos + _record.size + topiclen]))
+            pos += _record.size + topiclen + length
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.ticks = np.array(ticks, dtype=np.int64)
+        self.times = np.array(times, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def find(self, tick):
+        """Returns the index of the first record with a tick of at least tick. The ticks of
+        several markets are interleaved in a recording, so they are not necessarily sorted."""
+        after = np.flatnonzero(self.ticks >= tick)
+        return int(after[0]) if len(after) else len(self)
+
+    def read(self, i):
+        """Returns (topic, tick, ns since start, payload) of record i, with topic and payload as bytes."""
+        pos = int(self.offsets[i])
+        length, tick, ns, topiclen = _record.unpack_from(self.map, pos)
+        pos += _record.size
+        topic = bytes(self.map[pos:pos + topiclen])
+        pos += topiclen
+        return topic, tick, ns, zlib.decompress(self.map[pos:pos + length])
+
+    def close(self):
+        self.map.close()
+        self.file.close()
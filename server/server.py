@@ -2,11 +2,19 @@
 """The server generates stock data and distributes it to clients."""
 
 import arguments
+import collections
+import engine
+import heapq
 import json
+import multiprocessing
+import os
 import random
+import recording
 import sys
 import time
+import valuation
 
+import numpy as np
 import zmq
 
 _random = random.SystemRandom()
@@ -14,6 +22,12 @@ _random = random.SystemRandom()
 _maxinitvalue = 10000
 _splitvalue = 20000
 _maxhistory = 100
+# Time in ms subscribers get to connect before a replay starts.
+_replay_warmup = 1000
+# Number of clean feed reports after which a slow subscriber is no longer considered slow.
+_slow_recovery = 5
+# Maximum number of callbacks handled, and of recorded ticks replayed, in one go.
+_maxbatch = 1000
 
 class Log:
     def __init__(self, file=sys.stderr):
@@ -26,7 +40,8 @@ LOG = None
 
 class Groups:
     """Groups manages depot subscriptions for groups."""
-    groups = {}
+    def __init__(self):
+        self.groups = {}
 
     def update(self, group, user, info):
         """updates user info in a group. info is a dict containing the fields 'cash'."""
@@ -40,7 +55,138 @@ class Groups:
         """gets a dict with 'user' -> {'depot': _} mapping."""
         return self.groups.get(group, None)
 
-_groups = Groups()
+class Depots:
+    """Depots keeps the depot last reported by every user.
+
+    Clients send versioned deltas: a message with version v and base b contains everything that
+    changed after version b, so it can be applied to any stored depot with a version between b
+    and v. Messages without changes only carry the version and cost nothing to apply.
+
+    Users with an account in the execution engine are valued by the engine; their reported
+    depots are only compared with it, to catch clients whose depot drifted from the account.
+    """
+    def __init__(self):
+        # user -> {'version': int, 'cash': cents, 'stock': {symbol: num}}
+        self.depots = {}
+        # Users whose last reported depot didn't match their account.
+        self.drifted = set()
+
+    def apply(self, user, message):
+        """Applies a depot message. Returns the stored version, or None if the client has to
+        send its full depot."""
+        version = message.get('version', 0)
+        if message.get('full') or 'version' not in message:
+            stock = {sym: s.get('num', 0) for sym, s in message.get('stock', {}).items()}
+            self.depots[user] = {'version': version, 'cash': message.get('cash', 0),
+                                 'stock': {sym: num for sym, num in stock.items() if num}}
+            return version
+
+        depot = self.depots.get(user)
+        if depot is None or message.get('base', 0) > depot['version']:
+            return None
+        if version <= depot['version']:
+            # Old or empty delta.
+            return depot['version']
+        if 'cash' in message:
+            depot['cash'] = message['cash']
+        for sym, s in message.get('stock', {}).items():
+            num = s.get('num', 0)
+            if num:
+                depot['stock'][sym] = num
+            else:
+                depot['stock'].pop(sym, None)
+        depot['version'] = version
+        return version
+
+    def drifts(self, user, cash, positions):
+        """Returns True if the depot of user differed from the given account in two reports in a
+        row. A single difference is expected while execution results are on their way."""
+        depot = self.depots.get(user)
+        if depot is None or (depot['cash'] == cash and depot['stock'] == {s: n for s, n in positions.items() if n}):
+            self.drifted.discard(user)
+            return False
+        if user not in self.drifted:
+            self.drifted.add(user)
+            return False
+        self.drifted.discard(user)
+        return True
+
+    def value(self, user, data):
+        """Returns cash plus the value of the user's holdings at the prices in data."""
+        depot = self.depots.get(user)
+        if depot is None:
+            return -1
+        return depot['cash'] + sum(num * data[sym]['price'] for sym, num in depot['stock'].items() if sym in data)
+
+
+def callback_endpoint(endpoint):
+    """Returns the endpoint of the callback socket belonging to the feed bound at endpoint: the
+    port above for TCP, and the same endpoint with .callback appended otherwise."""
+    transport, _, where = endpoint.partition('://')
+    if transport != 'tcp':
+        return endpoint + '.callback'
+    host, _, port = where.rpartition(':')
+    return 'tcp://{}:{}'.format(host, int(port) + 1)
+
+
+class FeedMonitor:
+    """FeedMonitor keeps track of the subscribers of the feed.
+
+    The XPUB socket reports every subscription, and clients report the newest tick they
+    received and how many ticks they missed along with their depot messages. A subscriber
+    whose queue overflowed -- it missed ticks since its last report -- or that lags more than
+    max_lag ticks behind is slow. Slow subscribers are told so and conflate their feed until
+    they have sent a few clean reports. The publisher drops ticks for a slow subscriber, but
+    never waits for it, so it doesn't affect the others.
+    """
+    def __init__(self, max_lag=20):
+        self.max_lag = max_lag
+        # topic -> number of subscriptions
+        self.subscriptions = collections.Counter()
+        # (market, user) -> {'tick': int, 'dropped': int, 'lag': int, 'slow': bool, 'clean': int}
+        self.clients = {}
+        # Number of ticks clients have reported missing, in total.
+        self.dropped = 0
+
+    def subscription(self, frame):
+        """Processes a (un)subscription message received on the XPUB socket."""
+        if not frame:
+            return
+        topic = bytes(frame[1:])
+        if frame[0] == 1:
+            self.subscriptions[topic] += 1
+        elif self.subscriptions[topic] > 1:
+            self.subscriptions[topic] -= 1
+        else:
+            del self.subscriptions[topic]
+        LOG.log('{} subscribers to {!r}'.format(self.subscriptions[topic], topic))
+
+    def report(self, market, user, stats):
+        """Records the feed statistics reported by user. Returns whether its subscription is slow,
+        or None if the report is invalid."""
+        tick, dropped = stats.get('tick'), stats.get('dropped')
+        if not isinstance(tick, int) or not isinstance(dropped, int):
+            return None
+        key = (market.name, user)
+        client = self.clients.get(key) or {'tick': 0, 'dropped': dropped, 'lag': 0, 'slow': False, 'clean': 0}
+        # Counters going backwards belong to a restarted client.
+        new = dropped - client['dropped'] if dropped >= client['dropped'] else dropped
+        lag = max(market.tick - tick, 0)
+        self.dropped += new
+
+        slow = client['slow']
+        if new > 0 or lag > self.max_lag:
+            slow, client['clean'] = True, 0
+        elif slow:
+            client['clean'] += 1
+            slow = client['clean'] < _slow_recovery
+        if slow != client['slow']:
+            LOG.log('subscriber {} of market {!r} is {}: lag {} ticks, {} dropped ({} new)'.format(
+                user, market.name, 'slow' if slow else 'ok again', lag, dropped, new))
+        client.update(tick=tick, dropped=dropped, lag=lag, slow=slow)
+        self.clients[key] = client
+        return slow
+
 
 class Stock:
         symbol = ''
@@ -61,7 +207,8 @@ class Stock:
             self.symbol = name
             self._stddev = _random.random() / 10
             self._current_value = _random.random() * _maxinitvalue
-            self._last_values.append(self._current_value)
+            # Per instance; the class attribute would be shared by all stocks of all markets.
+            self._last_values = [self._current_value]
 
         def next_price(self):
             """Calculates a (random) next price based on the current price and history. Returns a dict suitable for inclusion in a _stockdata object."""
@@ -89,7 +236,16 @@ class Stock:
             return (sum(self._last_values)/len(self._last_values) < self.BANKRUPCY_LIMIT)
 
 
+def listing_event(event, symbol, tick, price):
+    """Returns a 'listed' or 'delisted' event for the _events list of a tick. The price is the
+    first price of a listed stock, and the final price of a delisted one."""
+    return {'event': event, 'symbol': symbol, 'tick': tick, 'price': price}
+
+
 class StockData:
+        """StockData is the message published every tick: symbol -> stock update, plus '_tick'
+        with the number of the tick and, if any stocks were listed or delisted in the tick,
+        '_events' with their listing events."""
         _data = {}
 
         def __init__(self, data):
@@ -119,18 +275,260 @@ class Stocks:
         def __init__(self, stocks=None):
             """Takes [Stock]."""
             self._stocks = stocks
+            # Number of the last generated tick.
+            self.tick = 0
 
         def generate(self):
-            next = {}
+            self.tick += 1
+            next = {'_tick': self.tick}
+            events = []
             for i in range(0, len(self._stocks)):
                 s = self._stocks[i]
                 if s.is_bankrupt():
+                    events.append(listing_event('delisted', s.symbol, self.tick, s.current_value()))
                     self._stocks[i] = Stock(Stock.name())
                     s = self._stocks[i]
+                    next[s.symbol] = s.next_price()
+                    events.append(listing_event('listed', s.symbol, self.tick, s.current_value()))
+                    continue
                 next[s.symbol] = s.next_price()
+            if events:
+                next['_events'] = events
+            return StockData(next)
+
+
+class FactorStocks:
+        """FactorStocks generates correlated prices for a whole universe of stocks at once.
+
+        Every stock's return loads on a market factor and on the factor of its sector, plus
+        idiosyncratic noise sized so that the total volatility matches the independent model.
+        All of it is kept in arrays, so a tick costs O(N*k) for N stocks and k factors.
+        """
+
+        # Volatility of the market factor and the sector factors.
+        MARKET_VOL = 0.008
+        SECTOR_VOL = 0.01
+        # Total volatility and drift per tick, as in Stock.next_price().
+        VOL = 0.02
+        DRIFT = 0.0005
+
+        def __init__(self, names, factors):
+            """Takes the ticker symbols and the number of factors (the market plus k-1 sectors)."""
+            self.rng = np.random.default_rng(_random.getrandbits(64))
+            self.k = max(int(factors), 1)
+            self.symbols = list(names)
+            n = len(self.symbols)
+            self.loadings = np.zeros((n, self.k))
+            self.idio = np.zeros(n)
+            self.prices = np.zeros(n)
+            self.history = np.zeros((_maxhistory, n), dtype=np.float32)
+            self.history_sum = np.zeros(n)
+            self.history_len = np.zeros(n, dtype=np.int64)
+            self.factor_vol = np.full(self.k, self.SECTOR_VOL)
+            self.factor_vol[0] = self.MARKET_VOL
+            self.tick = 0
+            self.list_stocks(np.arange(n))
+
+        def list_stocks(self, idx):
+            """(Re)initializes the stocks at positions idx with new prices, loadings and history."""
+            n = len(idx)
+            self.prices[idx] = self.rng.random(n) * _maxinitvalue
+            self.loadings[idx] = 0
+            self.loadings[idx, 0] = self.rng.uniform(0.5, 1.5, n)
+            if self.k > 1:
+                self.loadings[idx, self.rng.integers(1, self.k, n)] = self.rng.uniform(0.5, 1.5, n)
+            systematic = ((self.loadings[idx] * self.factor_vol) ** 2).sum(axis=1)
+            self.idio[idx] = np.sqrt(np.maximum(self.VOL ** 2 - systematic, (self.VOL / 4) ** 2))
+            self.history[:, idx] = 0
+            self.history_sum[idx] = 0
+            self.history_len[idx] = 0
+
+        def rename(self, idx):
+            taken = set(self.symbols)
+            for i in idx:
+                name = Stock.name()
+                while name in taken:
+                    name = Stock.name()
+                taken.add(name)
+                self.symbols[i] = name
+
+        def generate(self):
+            self.tick += 1
+            listed = self.history_len > 0
+            bankrupt = np.flatnonzero(listed & (self.history_sum < Stock.BANKRUPCY_LIMIT * self.history_len))
+            events = []
+            if len(bankrupt):
+                events = [listing_event('delisted', self.symbols[i], self.tick, p)
+                          for i, p in zip(bankrupt, self.prices[bankrupt].tolist())]
+                self.rename(bankrupt)
+                self.list_stocks(bankrupt)
+
+            factors = self.rng.standard_normal(self.k) * self.factor_vol
+            returns = self.loadings @ factors + self.idio * self.rng.standard_normal(len(self.prices))
+            prices = np.abs(np.trunc(self.prices * (1 + self.DRIFT + returns)))
+            split = prices > _splitvalue
+            prices[split] /= 2
+            self.prices = prices
+
+            # Keep the last _maxhistory prices in a ring, and their sum for the bankruptcy check.
+            slot = self.tick % _maxhistory
+            full = self.history_len >= _maxhistory
+            self.history_sum += prices - np.where(full, self.history[slot], 0)
+            self.history_len += ~full
+            self.history[slot] = prices
+
+            next = {'_tick': self.tick}
+            for sym, price, s in zip(self.symbols, prices.tolist(), split.tolist()):
+                next[sym] = {'price': price, 'split': s, '_stockupdate': True}
+            if events:
+                events += [listing_event('listed', self.symbols[i], self.tick, next[self.symbols[i]]['price'])
+                           for i in bankrupt]
+                next['_events'] = events
             return StockData(next)
 
 
+class Market:
+    """Market is one independent game: a stock universe with its own interval, execution
+    engine, groups and depots."""
+
+    def __init__(self, name, stocks, interval, batch_valuation=False, history=_maxhistory):
+        self.name = name
+        self.stocks = stocks
+        self.interval = interval
+        self.engine = engine.ExecutionEngine()
+        self.portfolios = valuation.Portfolios() if batch_valuation else None
+        self.groups = Groups()
+        self.depots = Depots()
+        # Index of the worker generating this market's ticks, and whether it is doing so now.
+        self.worker = None
+        self.busy = False
+        # Number of the last published tick.
+        self.tick = 0
+        # (tick, payload) of the last published ticks, for clients catching up.
+        self.recent = collections.deque(maxlen=history)
+        self._last_data = {}
+
+    def topic(self):
+        """Returns the PUB topic frame of this market; the default market has none."""
+        return self.name.encode('utf-8') + b' ' if self.name else None
+
+    def needs_data(self):
+        """Returns True if ticks have to be processed after publishing, not only published."""
+        return bool(self.portfolios is not None or self.engine.pending() or self.engine.holders
+                    or self.depots.depots)
+
+    def execute_orders(self, data):
+        """Executes all pending orders against data. Returns a list of (address, result)."""
+        self._last_data = data
+        results = self.engine.execute(data)
+        if self.portfolios is not None:
+            self.portfolios.tick(data)
+            for user in self.engine.touched:
+                acct = self.engine.accounts[user]
+                self.portfolios.load(user, acct.cash, acct.positions)
+            self.portfolios.revalue()
+        return results
+
+    def value(self, user):
+        """Returns the (cash, value) of user, or None if the user's depot is unknown."""
+        if self.portfolios is not None and user in self.portfolios.users:
+            row = self.portfolios.users[user]
+            return float(self.portfolios.cash[row]), self.portfolios.value(user)
+        # The server's own accounting beats whatever the client reports.
+        if user in self.engine.accounts:
+            return self.engine.accounts[user].cash, self.engine.value(user, self._last_data)
+        if user in self.depots.depots:
+            return self.depots.depots[user]['cash'], self.depots.value(user, self._last_data)
+        return None
+
+    def group_info(self, group):
+        """Returns the group's members with their current cash and value."""
+        members = self.groups.get(group) or {}
+        # The server's accounting is exact to the last tick, so prefer it to the stored values;
+        # members that never send depots (like bots) are only known to it.
+        info = {}
+        for user in members:
+            v = self.value(user)
+            info[user] = {'cash': v[0], 'value': v[1]} if v else members[user]
+        return info
+
+    def handle_message(self, user, group, password, message, origin=None, msg_id=None, session=None):
+        """Returns the complete response to send to a client.
+
+        origin is the ROUTER envelope of the client, used to send execution results later;
+        msg_id and session identify the message among all messages of the client."""
+        if '_stocklogin' in message:
+            acct = self.engine.account(user)
+            if self.portfolios is not None:
+                self.portfolios.load(user, acct.cash, acct.positions)
+            # Members are listed from their login on, whether they send depots or not.
+            cash, value = self.value(user)
+            self.groups.update(group, user, {'cash': cash, 'value': value})
+            return {'_stockresp': True, 'ok': True, 'account': acct.to_dict()}
+        if message.get('type') == 'order':
+            error = self.engine.submit(user, message, origin=origin, order_id=msg_id, session=session)
+            if error == engine.DUPLICATE:
+                # The result is sent for the original order.
+                return {'_stockresp': True, 'ok': True, 'accepted': True, 'duplicate': True}
+            if error:
+                return {'_stockresp': True, 'ok': False, 'error': error}
+            return {'_stockresp': True, 'ok': True, 'accepted': True}
+        if '_stockhistory' in message:
+            since = message.get('since', 0)
+            if not isinstance(since, int):
+                return {'_stockresp': True, 'ok': False, 'error': 'since must be a tick number'}
+            history = [payload.decode('utf-8') for tick, payload in self.recent if tick > since]
+            return {'_stockresp': True, 'ok': True, 'history': history}
+        if '_stockdepot' in message:
+            version = self.depots.apply(user, message)
+            if version is None:
+                return {'_stockresp': True, 'ok': False, 'resync': True}
+            if self.portfolios is not None and user not in self.engine.accounts:
+                depot = self.depots.depots[user]
+                self.portfolios.load(user, depot['cash'], depot['stock'])
+            cash, value = self.value(user)
+            self.groups.update(group, user, {'cash': cash, 'value': value})
+            resp = {'_stockresp': True, 'ok': True, 'version': version, 'groupinfo': self.group_info(group)}
+            acct = self.engine.accounts.get(user)
+            if acct is not None and self.depots.drifts(user, acct.cash, acct.positions):
+                # The account is authoritative; the client replaces its depot by it.
+                LOG.log('depot of {} drifted from its account'.format(user))
+                resp['account'] = acct.to_dict()
+            return resp
+
+
+def _market_worker(conn, markets, parent):
+    """Runs in a worker process and generates ticks for the markets (name -> Stocks) it owns.
+
+    Receives (name, needs_data) and answers (name, tick, serialized tick, tick data or None)."""
+    while True:
+        # Forked workers share the server's end of the pipe, so they won't see EOF when it exits.
+        if not conn.poll(1):
+            if os.getppid() != parent:
+                return
+            continue
+        req = conn.recv()
+        if req is None:
+            return
+        name, needs_data = req
+        data = markets[name].generate()
+        conn.send((name, markets[name].tick, data.serialize(), data.data() if needs_data else None))
+
+
+class MarketWorker:
+    """MarketWorker is a worker process generating ticks for a share of the markets."""
+
+    def __init__(self, markets):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_market_worker, args=(child, markets, os.getpid()),
+                                               daemon=True)
+        self.process.start()
+        child.close()
+
+    def fileno(self):
+        return self.conn.fileno()
+
+
 class Server(arguments.BaseArguments):
         _doc = """
     Usage:
@@ -141,13 +539,33 @@ class Server(arguments.BaseArguments):
         -p --port=<port>        Listen on port (the port directly above will also be used)
         --stocks=<stocks>       Number of stocks to generate.
         --stocklist=<stocks>    List of ticker symbols to generate stocks for.
+        --factors=<factors>     Generate correlated prices from this many shared factors (the
+                                market and sectors) instead of independent prices.
         --interval=<interval>   Interval in ms to publish stock data (default 500)
+        --markets=<markets>     Host several independent markets, given as a comma-separated
+                                list of name[:stocks[:interval]]. Each market is published
+                                under its name as topic.
+        --workers=<workers>     Number of worker processes generating ticks (default 0: none).
+        --batch-valuation       Revalue all portfolios on the server every tick.
+        --bind=<endpoints>      Comma-separated list of additional ZMQ endpoints to publish on,
+                                such as ipc:///tmp/stex or inproc://stex. The callback socket
+                                is bound at each endpoint with .callback appended (at the port
+                                above, for TCP endpoints).
+        --hwm=<ticks>           Number of ticks queued for a subscriber before further ticks are
+                                dropped for it (default 1000).
+        --sndbuf=<bytes>        Kernel send buffer size of the sockets.
+        --keepalive=<seconds>   Enable TCP keepalive, probing connections idle this long.
+        --max-lag=<ticks>       Consider subscribers lagging more ticks behind slow (default 20).
+        --history=<ticks>       Number of published ticks kept per market for clients catching
+                                up after reconnecting (default 100).
+        --record=<file>         Record all published ticks to file.
+        --replay=<file>         Publish the ticks recorded in file instead of generating them.
+        --speed=<speed>         Replay speed multiplier; 0 replays as fast as possible (default 1).
+        --seek=<tick>           Start replaying at this tick.
         --log=<file>            Log file.
         --help                  Print help.
     """
 
-        _stocks = Stocks(None)
-
         def __init__(self, zctx, callback=None):
             """callback is called with a StockData object every time new data are available."""
             super(arguments.BaseArguments, self).__init__(doc=self._doc)
@@ -156,21 +574,47 @@ class Server(arguments.BaseArguments):
                 print(self._doc)
                 sys.exit(0)
 
+            self.callback = callback
+            self._monitor = FeedMonitor(int(self.max_lag or 20))
+            self._recorder = recording.Recorder(self.record) if self.record else None
+            self._recording = recording.Recording(self.replay) if self.replay else None
+            self.init_markets()
+            # Fork workers before any sockets are bound, so they don't inherit them.
+            self.init_workers()
+
             port = self.port or '9988'
+            endpoints = ['tcp://{}:{}'.format(self.address or '[::]', port)]
+            endpoints += self.bind.split(',') if self.bind else []
 
             interactivesocket = zctx.socket(zmq.ROUTER)
-            interactivesocket.setsockopt(zmq.IPV6, 1)
-            interactivesocket.bind('tcp://{}:{}'.format(self.address or '[::]', int(port) + 1 if self.port else 9989))
+            self.setup_socket(interactivesocket)
+            for endpoint in endpoints:
+                interactivesocket.bind(callback_endpoint(endpoint))
             interactivesocket.setsockopt(zmq.RCVTIMEO, 0)
             self.interactivesocket = interactivesocket
 
-            pubsocket = zctx.socket(zmq.PUB)
-            pubsocket.setsockopt(zmq.IPV6, 1)
-            pubsocket.bind('tcp://{}:{}'.format(self.address or '[::]', port))
+            # An XPUB socket, to learn about subscriptions. It drops ticks for subscribers
+            # whose queue is full instead of blocking.
+            pubsocket = zctx.socket(zmq.XPUB)
+            self.setup_socket(pubsocket)
+            pubsocket.setsockopt(zmq.SNDHWM, int(self.hwm or 1000))
+            pubsocket.setsockopt(zmq.XPUB_VERBOSER, 1)
+            for endpoint in endpoints:
+                pubsocket.bind(endpoint)
             self.pubsocket = pubsocket
-            self.init_stocks()
+            LOG.log('listening on {}'.format(', '.join(endpoints)))
+
+        def setup_socket(self, sock):
+            """Applies the socket options, which have to be set before binding."""
+            sock.setsockopt(zmq.IPV6, 1)
+            if self.sndbuf:
+                sock.setsockopt(zmq.SNDBUF, int(self.sndbuf))
+            if self.keepalive:
+                sock.setsockopt(zmq.TCP_KEEPALIVE, 1)
+                sock.setsockopt(zmq.TCP_KEEPALIVE_IDLE, int(self.keepalive))
 
         def setup_log(self):
+            global LOG
             if self.log is not None:
                 # Attempt to create file if it doesn't exist.
                 try:
@@ -179,43 +623,182 @@ class Server(arguments.BaseArguments):
                 except:
                     pass
                 log = open(self.log, mode='a')
-                global LOG
                 LOG = Log(log)
             else:
                 LOG = Log()
 
-        def init_stocks(self):
+        def init_stocks(self, stocks=None):
             stocklist = []
             if self.stocklist:
                 stocklist = self.stocklist.split(',')
-            elif self.stocks and int(self.stocks) > 0:
-                stocklist = [Stock.name() for _ in range(0, self.stocks)]
+            elif stocks or (self.stocks and int(self.stocks) > 0):
+                stocklist = [Stock.name() for _ in range(0, int(stocks or self.stocks))]
             else:
                 stocklist = [Stock.name() for _ in range(0, 10)]
 
+            if self.factors:
+                return FactorStocks(stocklist, self.factors)
             stocklist = [Stock(name=s) for s in stocklist]
-            self._stocks = Stocks(stocklist)
+            return Stocks(stocklist)
 
-        def run(self):
+        def init_markets(self):
             interval = int(self.interval or 500)
-            nextinterval = interval
+            options = {'batch_valuation': bool(self.batch_valuation),
+                       'history': int(self.history) if self.history is not None else _maxhistory}
+            self._markets = {}
+            if self._recording is not None:
+                # Replayed markets are the ones in the recording, with their topic's name.
+                for topic in self._recording.topics:
+                    name = topic.decode('utf-8').rstrip(' ')
+                    self._markets[name] = Market(name, None, interval, **options)
+                return
+            if not self.markets:
+                self._markets[''] = Market('', self.init_stocks(), interval, **options)
+                return
+            for spec in self.markets.split(','):
+                name, _, rest = spec.partition(':')
+                stocks, _, minterval = rest.partition(':')
+                # Names starting with '{' would be received by subscribers of the default market.
+                if not name or ' ' in name or name.startswith('{') or name in self._markets:
+                    raise ValueError('invalid or duplicate market name: {!r}'.format(name))
+                self._markets[name] = Market(name, self.init_stocks(stocks or None), int(minterval or interval),
+                                            **options)
+
+        def init_workers(self):
+            """Distributes the markets over the worker processes, which take ownership of the
+            markets' stocks."""
+            self._workers = []
+            nworkers = min(int(self.workers or 0), len(self._markets))
+            if nworkers <= 0 or self._recording is not None:
+                return
+            shares = [{} for _ in range(nworkers)]
+            for i, market in enumerate(self._markets.values()):
+                market.worker = i % nworkers
+                shares[market.worker][market.name] = market.stocks
+            self._workers = [MarketWorker(share) for share in shares]
+            LOG.log('started {} workers for {} markets'.format(nworkers, len(self._markets)))
 
+        def run(self):
+            if self._recording is not None:
+                return self.run_replay()
             p = zmq.Poller()
             p.register(self.interactivesocket, zmq.POLLIN)
+            p.register(self.pubsocket, zmq.POLLIN)
+            for w in self._workers:
+                p.register(w.fileno(), zmq.POLLIN)
+
+            now = time.clock_gettime_ns(time.CLOCK_MONOTONIC) / 1e6
+            schedule = [(now + m.interval, m.name) for m in self._markets.values()]
+            heapq.heapify(schedule)
             while True:
-                before = time.clock_gettime_ns(time.CLOCK_MONOTONIC)
-                events = p.poll(nextinterval)
-                if len(events) > 0:
-                    self.handle_calls(events)
-                    diff = (time.clock_gettime_ns(time.CLOCK_MONOTONIC) - before) / 1e6
-                    remaining = nextinterval - diff
-                    nextinterval = remaining if remaining > 0 else 0
-                else:  # Timeout
-                    nextdata = self._stocks.generate()
-                    self.pubsocket.send_string(nextdata.serialize())
-                    nextinterval = interval
-
-        groups = Groups()
+                now = time.clock_gettime_ns(time.CLOCK_MONOTONIC) / 1e6
+                events = dict(p.poll(max(schedule[0][0] - now, 0)))
+                if self.interactivesocket in events:
+                    self.drain_calls()
+                if self.pubsocket in events:
+                    self.handle_subscriptions()
+                for w in self._workers:
+                    if w.fileno() in events:
+                        self.collect(w)
+
+                now = time.clock_gettime_ns(time.CLOCK_MONOTONIC) / 1e6
+                while schedule[0][0] <= now:
+                    deadline, name = heapq.heappop(schedule)
+                    market = self._markets[name]
+                    self.tick(market)
+                    # If we fell behind, skip ticks instead of bursting.
+                    heapq.heappush(schedule, (max(deadline + market.interval, now), name))
+
+        def tick(self, market):
+            """Generates and publishes the next tick of market, or has a worker generate it."""
+            if market.worker is None:
+                nextdata = market.stocks.generate()
+                self.publish(market, market.stocks.tick, nextdata.serialize(), nextdata.data())
+                return
+            if market.busy:
+                LOG.log('worker {} is behind, skipping tick of market {}'.format(market.worker, market.name))
+                return
+            market.busy = True
+            self._workers[market.worker].conn.send((market.name, market.needs_data() or self.callback is not None))
+
+        def collect(self, worker):
+            """Publishes all ticks a worker has finished."""
+            while worker.conn.poll():
+                name, tick, payload, data = worker.conn.recv()
+                market = self._markets[name]
+                market.busy = False
+                self.publish(market, tick, payload, data)
+
+        def run_replay(self):
+            """Publishes the recorded ticks, starting at --seek, at --speed times the recorded pace."""
+            rec = self._recording
+            speed = float(self.speed if self.speed is not None else 1)
+            i = rec.find(int(self.seek or 0))
+            LOG.log('replaying {} of {} ticks at speed {}'.format(len(rec) - i, len(rec), speed or 'max'))
+
+            p = zmq.Poller()
+            p.register(self.interactivesocket, zmq.POLLIN)
+            p.register(self.pubsocket, zmq.POLLIN)
+            start = time.clock_gettime_ns(time.CLOCK_MONOTONIC) + _replay_warmup * 1e6
+            base = rec.times[i] if i < len(rec) else 0
+            while i < len(rec):
+                now = time.clock_gettime_ns(time.CLOCK_MONOTONIC)
+                due = start + (rec.times[i] - base) / speed if speed > 0 else start
+                events = dict(p.poll(max(due - now, 0) / 1e6))
+                if self.interactivesocket in events:
+                    self.drain_calls()
+                if self.pubsocket in events:
+                    self.handle_subscriptions()
+
+                # Publish everything that is due, so that callbacks don't hold up the replay.
+                now = time.clock_gettime_ns(time.CLOCK_MONOTONIC)
+                for _ in range(_maxbatch):
+                    if i >= len(rec) or (speed > 0 and start + (rec.times[i] - base) / speed > now):
+                        break
+                    topic, tick, _, payload = rec.read(i)
+                    market = self._markets[topic.decode('utf-8').rstrip(' ')]
+                    data = json.loads(payload) if market.needs_data() or self.callback else None
+                    self.publish(market, tick, payload, data)
+                    i += 1
+            LOG.log('replay finished')
+
+        def publish(self, market, tick, payload, data):
+            """Publishes a serialized tick (str or bytes) and processes its data, if given."""
+            if isinstance(payload, str):
+                payload = payload.encode('utf-8')
+            market.tick = tick
+            topic = market.topic()
+            if topic is None:
+                self.pubsocket.send(payload)
+            else:
+                self.pubsocket.send_multipart([topic, payload])
+            market.recent.append((tick, payload))
+            if self._recorder is not None:
+                self._recorder.write(topic, tick, payload)
+            # Orders are executed only after publishing, so they never delay the feed.
+            if data is None:
+                return
+            if self.callback:
+                self.callback(StockData(data))
+            for (address, result) in market.execute_orders(data):
+                if address is None:
+                    continue
+                self.interactivesocket.send_multipart(address + [bytes(json.dumps(result), 'utf-8')])
+
+        def handle_subscriptions(self):
+            """Processes the (un)subscriptions received on the feed socket."""
+            while True:
+                try:
+                    self._monitor.subscription(self.pubsocket.recv(flags=zmq.NOBLOCK))
+                except zmq.Again:
+                    return
+
+        def drain_calls(self):
+            """Handles the callbacks waiting, up to a batch of them."""
+            for _ in range(_maxbatch):
+                if not self.interactivesocket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                    return
+                self.handle_calls([(self.interactivesocket, zmq.POLLIN)])
 
         # Handle callbacks from clients.
         def handle_calls(self, events):
@@ -229,20 +812,28 @@ class Server(arguments.BaseArguments):
                     LOG.log('Client {}: {} {}'.format(msgs[0].hex(), msgs[1].decode(), msg))
 
                     custom_msg = msg.get('msg', {})
-                    resp = self.handle_message(msg['user'], msg['group'], msg['password'], custom_msg)
+                    market = self._markets.get(msg.get('market') or '')
+                    if market is None:
+                        resp = {'_stockresp': True, 'ok': False, 'error': '{} market; this server hosts {}'.format(
+                            'unknown' if msg.get('market') else 'no default',
+                            ', '.join(sorted(name or '(default)' for name in self._markets)))}
+                    else:
+                        resp = market.handle_message(msg['user'], msg['group'], msg['password'], custom_msg,
+                                                     origin=msgs[:2], msg_id=msg.get('id'),
+                                                     session=msg.get('session'))
+                        if resp and resp.get('ok') and isinstance(custom_msg.get('feed'), dict):
+                            slow = self._monitor.report(market, msg['user'], custom_msg['feed'])
+                            if slow is not None:
+                                resp['slow'] = slow
+                    if resp is None:
+                        resp = {'_stockresp': True, 'ok': False}
+                    # Clients match responses to their requests by ID, so always echo it.
+                    if 'id' in msg:
+                        resp['id'] = msg['id']
                     sock.send_multipart([msgs[0], msgs[1], bytes(json.dumps(resp), 'utf-8')])
                 except Exception as e:
                     raise e
 
-        def handle_message(self, user, group, password, message):
-            """Returns the complete response to send to a client."""
-            if '_stocklogin' in message:
-                return {}
-            if '_stockdepot' in message:
-                groupinfo = {'cash': message.get('cash', -1), 'value': message.get('value', -1)}
-                _groups.update(group, user, groupinfo)
-                return {'_stockresp': True, 'ok': True, 'groupinfo': _groups.get(group)}
-
 def main():
         ctx = zmq.Context()
         s = Server(ctx)
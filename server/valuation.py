@@ -0,0 +1,140 @@
+"""Batched valuation of all users' portfolios."""
+
+import numpy as np
+
+
+class Portfolios:
+    """Portfolios holds the holdings of all users as a sparse users x symbols matrix and
+    revalues all of them at once on every tick.
+
+    The matrix is stored in coordinate form: slot i holds qty[i] pieces of symbol cols[i] owned
+    by user rows[i]. Emptied slots are reused. Revaluing is a sparse matrix-vector product with
+    the price vector, and a split is a scaling of the split symbol's column, so the cost of a
+    tick is proportional to the number of non-zero holdings.
+    """
+
+    def __init__(self, capacity=1024):
+        self.users = {}
+        # Listed symbols -> column. Columns of delisted symbols are not reused.
+        self.symbols = {}
+        self.ncols = 0
+        self.live = np.zeros(0, dtype=bool)
+        self.rows = np.zeros(capacity, dtype=np.int64)
+        self.cols = np.zeros(capacity, dtype=np.int64)
+        self.qty = np.zeros(capacity, dtype=np.float64)
+        self.cash = np.zeros(0, dtype=np.float64)
+        self.values = np.zeros(0, dtype=np.float64)
+        self.prices = np.zeros(0, dtype=np.float64)
+        # The last tick, to price columns added after it.
+        self._data = {}
+        # Per row: column -> slot.
+        self._slots = []
+        self._free = list(range(capacity - 1, -1, -1))
+
+    def _row(self, user):
+        row = self.users.get(user)
+        if row is None:
+            row = len(self.users)
+            self.users[user] = row
+            self._slots.append({})
+            self.cash = np.append(self.cash, 0)
+            self.values = np.append(self.values, 0)
+        return row
+
+    def _col(self, sym):
+        col = self.symbols.get(sym)
+        if col is None:
+            col = self.ncols
+            self.ncols += 1
+            self.symbols[sym] = col
+            upd = self._data.get(sym)
+            self.prices = np.append(self.prices, upd['price'] if isinstance(upd, dict) else 0)
+            self.live = np.append(self.live, True)
+        return col
+
+    def _grow(self):
+        n = len(self.qty)
+        self.rows = np.concatenate([self.rows, np.zeros(n, dtype=np.int64)])
+        self.cols = np.concatenate([self.cols, np.zeros(n, dtype=np.int64)])
+        self.qty = np.concatenate([self.qty, np.zeros(n, dtype=np.float64)])
+        self._free.extend(range(2 * n - 1, n - 1, -1))
+
+    def set_position(self, user, sym, num):
+        row, col = self._row(user), self._col(sym)
+        slots = self._slots[row]
+        slot = slots.get(col)
+        if not num:
+            if slot is not None:
+                self.qty[slot] = 0
+                self._free.append(slots.pop(col))
+            return
+        if slot is None:
+            if not self._free:
+                self._grow()
+            slot = self._free.pop()
+            slots[col] = slot
+            self.rows[slot], self.cols[slot] = row, col
+        self.qty[slot] = num
+
+    def load(self, user, cash, positions):
+        """Replaces cash and all holdings of user. positions maps symbol -> number of pieces."""
+        row = self._row(user)
+        self.cash[row] = cash
+        wanted = {self._col(sym) for sym, num in positions.items() if num}
+        for col, slot in list(self._slots[row].items()):
+            if col not in wanted:
+                self.qty[slot] = 0
+                self._free.append(self._slots[row].pop(col))
+        for sym, num in positions.items():
+            self.set_position(user, sym, num)
+        self.values[row] = self.cash[row] + sum(self.qty[s] * self.prices[c] for c, s in self._slots[row].items())
+
+    def tick(self, data):
+        """Takes the prices of a new tick from data (a StockData dict), scales the columns of
+        split stocks and clears the columns of stocks that are gone."""
+        split = np.zeros(self.ncols, dtype=bool)
+        listed = np.zeros(self.ncols, dtype=bool)
+        prices = np.zeros(self.ncols, dtype=np.float64)
+        for sym, upd in data.items():
+            if sym.startswith('_'):
+                continue
+            col = self.symbols.get(sym)
+            if col is None:
+                continue
+            prices[col] = upd['price']
+            listed[col] = True
+            split[col] = upd.get('split', False)
+        self.prices = prices
+        self._data = data
+
+        if split.any():
+            self.qty *= np.where(split[self.cols], 2, 1)
+        gone = self.live & ~listed
+        if gone.any():
+            self._delist(gone)
+
+    def _delist(self, gone):
+        """Clears the columns marked in the boolean array gone."""
+        self.live &= ~gone
+        for sym in [s for s, c in self.symbols.items() if gone[c]]:
+            self.symbols.pop(sym)
+        for slot in np.flatnonzero(gone[self.cols] & (self.qty != 0)):
+            slots = self._slots[self.rows[slot]]
+            slots.pop(int(self.cols[slot]), None)
+            self.qty[slot] = 0
+            self._free.append(int(slot))
+
+    def revalue(self):
+        """Computes the value of every portfolio at the current prices."""
+        if self.ncols == 0:
+            self.values = self.cash.copy()
+            return self.values
+        holdings = np.bincount(self.rows, weights=self.qty * self.prices[self.cols], minlength=len(self.users))
+        self.values = self.cash + holdings[:len(self.users)]
+        return self.values
+
+    def value(self, user):
+        row = self.users.get(user)
+        if row is None:
+            return None
+        return float(self.values[row])